@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# bench.py
+# times SublimeXiki's hot paths outside the editor, using the stand-in
+# sublime module next to this file
+#
+#   python bench/bench.py [-o bench_output.txt] [--save FILE] [--compare FILE]
+#
+# --save records the results as JSON, --compare reports (and exits 1 on)
+# anything more than --threshold times slower than a saved run.
+
+import argparse
+import importlib
+import json
+import os
+import re
+import shlex
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import types
+
+here = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(here)
+sys.path.insert(0, here)
+
+import sublime
+
+XIKI_SYNTAX = 'Packages/SublimeXiki/Xiki.tmLanguage'
+
+def load_defaults():
+    with open(os.path.join(root, 'SublimeXiki.sublime-settings')) as f:
+        text = re.sub(r'^\s*//.*$', '', f.read(), flags=re.M)
+    sublime.load_settings('SublimeXiki.sublime-settings').values.update(json.loads(text))
+
+def load_plugin():
+    package = types.ModuleType('SublimeXiki')
+    package.__path__ = [root]
+    sys.modules['SublimeXiki'] = package
+    xiki = importlib.import_module('SublimeXiki.xiki')
+    xiki.plugin_loaded()
+    return xiki
+
+def new_view(text):
+    view = sublime.View(text, sublime.window)
+    view.settings().set('syntax', XIKI_SYNTAX)
+    sublime.window.views.append(view)
+    return view
+
+def close_view(view):
+    xiki.XikiListener().on_close(view)
+    sublime.window.views.remove(view)
+
+def tree_text(lines, fanout=6, depth=6):
+    '''
+    Returns a buffer of nested menu nodes, depth levels deep.
+    '''
+    out = []
+    def walk(level, prefix):
+        for i in range(fanout):
+            if len(out) >= lines:
+                return
+            sign = '+ ' if level < depth - 1 else ''
+            out.append('  ' * level + sign + '%s%i' % (prefix, i))
+            if level < depth - 1:
+                walk(level + 1, prefix + '%i.' % i)
+
+    while len(out) < lines:
+        walk(0, 'node%i.' % len(out))
+    return '\n'.join(out) + '\n'
+
+def measure(func, number=1, repeat=5, setup=None):
+    '''
+    Returns the median seconds per call of func over repeat runs.
+    '''
+    times = []
+    for _ in range(repeat):
+        args = setup() if setup else ()
+        start = time.perf_counter()
+        for _ in range(number):
+            func(*args)
+        times.append((time.perf_counter() - start) / number)
+    return statistics.median(times)
+
+# benchmarks, each returning a list of (name, seconds, note)
+
+def bench_find_tree():
+    view = new_view(tree_text(20000))
+    rows = list(range(0, 20000, 97))
+
+    def warm():
+        for row in rows:
+            xiki.find_tree(view, row)
+
+    def cold():
+        xiki.tree_indexes.clear()
+        xiki.find_tree(view, 19999)
+
+    results = [
+        ('find_tree', measure(warm, repeat=5) / len(rows), '20k line buffer, indexed'),
+        ('find_tree cold', measure(cold, number=5), '20k line buffer, builds the index'),
+    ]
+    close_view(view)
+    return results
+
+def bench_find_region():
+    children = '\n'.join('  child %i' % i for i in range(5000))
+    view = new_view('+ parent\n' + children + '\nsibling\n')
+    xiki.tree_index(view)
+
+    result = measure(lambda: xiki.find_region(view, 0, '  '), number=20)
+    close_view(view)
+    return [('find_region', result, '5k child lines')]
+
+def bench_insert():
+    text = '\n'.join('line %i' % i for i in range(1000))
+
+    def setup():
+        view = new_view(tree_text(20000))
+        view.sel().add(sublime.Region(0))
+        return view,
+
+    def run(view):
+        with xiki.Edit(view) as edit:
+            xiki.insert(view, edit, view.sel()[0], text, '  ')
+        close_view(view)
+
+    return [('insert', measure(run, setup=setup), '1k lines into a 20k line buffer')]
+
+def bench_expand_directory(tmp):
+    target = os.path.join(tmp, 'listing')
+    os.mkdir(target)
+    for i in range(5000):
+        open(os.path.join(target, 'file%05i.txt' % i), 'w').close()
+
+    def setup():
+        xiki.listing_cache.invalidate()
+        view = new_view('+ %s/\n' % target)
+        view.sel().add(sublime.Region(2))
+        return view,
+
+    def run(view):
+        view.run_command('xiki')
+        sublime.run_timeouts(lambda: not xiki.menus[view.id()])
+        close_view(view)
+
+    return [('expand directory', measure(run, setup=setup), '5k entries, uncached')]
+
+def bench_spawn(count=200000):
+    script = 'import sys; sys.stdout.writelines("output line %%i\\n" %% i for i in range(%i))' % count
+    # a leading / would make the line a path
+    tag = 'exec %s -c %s' % (shlex.quote(sys.executable), shlex.quote(script))
+
+    def setup():
+        view = new_view('$ %s\n' % tag)
+        view.sel().add(sublime.Region(2))
+        return view,
+
+    def run(view):
+        view.run_command('xiki')
+        sublime.run_timeouts(lambda: not xiki.commands[view.id()], timeout=60)
+        close_view(view)
+
+    seconds = measure(run, setup=setup, repeat=3)
+    return [('spawn + merge', seconds, '%i lines, %i lines/s' % (count, count / seconds))]
+
+def bench_completions(tmp):
+    target = os.path.join(tmp, 'completions')
+    os.mkdir(target)
+    for i in range(5000):
+        open(os.path.join(target, 'file%05i.txt' % i), 'w').close()
+
+    xiki.completions(target, 'file')
+    sublime.run_timeouts(lambda: xiki.completion_index(target) is not None)
+    warm = measure(lambda: xiki.completions(target, 'file012'), number=200)
+
+    def cold():
+        xiki.completion_cache.invalidate()
+        while not xiki.completions(target, 'file012'):
+            pass
+
+    return [
+        ('completions', warm, '5k entries, indexed'),
+        ('completions cold', measure(cold), '5k entries, builds the index'),
+    ]
+
+def run_all():
+    tmp = tempfile.mkdtemp(prefix='xiki-bench-')
+    try:
+        results = []
+        results += bench_find_tree()
+        results += bench_find_region()
+        results += bench_insert()
+        results += bench_expand_directory(tmp)
+        results += bench_spawn()
+        results += bench_completions(tmp)
+        return results
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+def format_seconds(seconds):
+    if seconds < 1e-3:
+        return '%.1fus' % (seconds * 1e6)
+    if seconds < 1:
+        return '%.2fms' % (seconds * 1e3)
+    return '%.2fs' % seconds
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark SublimeXiki outside of Sublime Text.')
+    parser.add_argument('-o', '--output', default=os.path.join(root, 'bench_output.txt'),
+        help='write the report here as well as to stdout')
+    parser.add_argument('--save', help='save the results as JSON')
+    parser.add_argument('--compare', help='compare against results saved with --save')
+    parser.add_argument('--threshold', type=float, default=1.25,
+        help='slowdown factor reported as a regression (default 1.25)')
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    results = run_all()
+    report = []
+    regressions = 0
+    for name, seconds, note in results:
+        line = '%-20s %10s  %s' % (name, format_seconds(seconds), note)
+        before = baseline.get(name)
+        if before:
+            ratio = seconds / before
+            line += '  (%.2fx baseline)' % ratio
+            if ratio > args.threshold:
+                line += ' REGRESSION'
+                regressions += 1
+        report.append(line)
+
+    text = '\n'.join(report) + '\n'
+    sys.stdout.write(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(dict((name, seconds) for name, seconds, _ in results), f, indent=4)
+
+    xiki.plugin_unloaded()
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    load_defaults()
+    xiki = load_plugin()
+    sys.exit(main())
@@ -0,0 +1,433 @@
+# sublime.py
+# in-memory stand-in for the parts of Sublime Text's API SublimeXiki uses,
+# so the plugin can be benchmarked outside the editor
+
+import bisect
+import heapq
+import itertools
+import threading
+import time
+
+HIDDEN = 128
+DRAW_OUTLINED = 256
+INHIBIT_WORD_COMPLETIONS = 8
+
+ids = itertools.count(1)
+
+def version():
+    return '4000'
+
+def status_message(msg):
+    pass
+
+# callbacks queued by set_timeout(), run on the benchmark's main thread by
+# run_timeouts(), which plays the part of the UI thread
+timeouts = []
+timeout_seq = itertools.count()
+timeout_cond = threading.Condition()
+
+def set_timeout(func, delay=0):
+    with timeout_cond:
+        heapq.heappush(timeouts, (time.time() + delay / 1000.0, next(timeout_seq), func))
+        timeout_cond.notify()
+
+set_timeout_async = set_timeout
+
+def run_timeouts(until=None, timeout=10.0):
+    '''
+    Runs queued callbacks until until() is true, or nothing is queued if
+    until is None. Raises RuntimeError if that takes more than timeout seconds.
+    '''
+    deadline = time.time() + timeout
+    while True:
+        if until is not None and until():
+            return
+
+        with timeout_cond:
+            now = time.time()
+            if now > deadline:
+                raise RuntimeError('timed out waiting for callbacks')
+
+            if not timeouts or timeouts[0][0] > now:
+                if until is None and not timeouts:
+                    return
+
+                wait = timeouts[0][0] - now if timeouts else deadline - now
+                timeout_cond.wait(min(wait, 0.01))
+                continue
+
+            _, _, func = heapq.heappop(timeouts)
+
+        func()
+
+class Region:
+    __slots__ = ('a', 'b')
+
+    def __init__(self, a, b=None):
+        if b is None:
+            b = a
+        self.a = a
+        self.b = b
+
+    def __repr__(self):
+        return 'Region(%i, %i)' % (self.a, self.b)
+
+    def __eq__(self, other):
+        return isinstance(other, Region) and self.a == other.a and self.b == other.b
+
+    def __hash__(self):
+        return hash((self.a, self.b))
+
+    def __len__(self):
+        return self.size()
+
+    def begin(self):
+        return min(self.a, self.b)
+
+    def end(self):
+        return max(self.a, self.b)
+
+    def size(self):
+        return abs(self.b - self.a)
+
+    def empty(self):
+        return self.a == self.b
+
+    def cover(self, other):
+        return Region(min(self.begin(), other.begin()), max(self.end(), other.end()))
+
+    def contains(self, x):
+        if isinstance(x, Region):
+            return self.begin() <= x.begin() and x.end() <= self.end()
+        return self.begin() <= x <= self.end()
+
+    def intersects(self, other):
+        return self.begin() < other.end() and other.begin() < self.end()
+
+class Selection:
+    def __init__(self):
+        self.regions = []
+
+    def __iter__(self):
+        return iter(list(self.regions))
+
+    def __len__(self):
+        return len(self.regions)
+
+    def __getitem__(self, i):
+        return self.regions[i]
+
+    def clear(self):
+        self.regions = []
+
+    def add(self, region):
+        if isinstance(region, int):
+            region = Region(region)
+        if region not in self.regions:
+            self.regions.append(Region(region.a, region.b))
+            self.regions.sort(key=Region.begin)
+
+    def subtract(self, region):
+        self.regions = [r for r in self.regions if not (r == region or r.intersects(region))]
+
+class Settings:
+    def __init__(self, values=None):
+        self.values = dict(values or {})
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+    def set(self, key, value):
+        self.values[key] = value
+
+    def has(self, key):
+        return key in self.values
+
+    def erase(self, key):
+        self.values.pop(key, None)
+
+    def add_on_change(self, tag, callback):
+        pass
+
+    def clear_on_change(self, tag):
+        pass
+
+settings = {}
+
+def load_settings(name):
+    return settings.setdefault(name, Settings())
+
+def save_settings(name):
+    pass
+
+class Position:
+    __slots__ = ('pt', 'row', 'col')
+
+    def __init__(self, pt, row, col):
+        self.pt = pt
+        self.row = row
+        self.col = col
+
+class TextChange:
+    def __init__(self, a, b, text):
+        self.a = a
+        self.b = b
+        self.str = text
+
+class Buffer:
+    def __init__(self, view):
+        self.buffer_id = next(ids)
+        self.view = view
+
+    def id(self):
+        return self.buffer_id
+
+    def primary_view(self):
+        return self.view
+
+def shift(point, pos, delta, erased_end=None):
+    if erased_end is not None:
+        if point >= erased_end:
+            return point + delta
+        if point > pos:
+            return pos
+        return point
+    return point + delta if point > pos else point
+
+class View:
+    def __init__(self, text='', window=None):
+        self.view_id = next(ids)
+        self.buffer = Buffer(self)
+        self.text = text
+        self.starts = None
+        self.changes = 0
+        self.selection = Selection()
+        self.regions = {}
+        self.folds = []
+        self.view_settings = Settings()
+        self.path = None
+        self.win = window
+        self.listeners = []
+
+        import sublime_plugin
+        for cls in sublime_plugin.text_change_listeners:
+            if cls.is_applicable(self.buffer):
+                listener = cls()
+                listener.buffer = self.buffer
+                self.listeners.append(listener)
+
+    # identity
+
+    def id(self):
+        return self.view_id
+
+    def buffer_id(self):
+        return self.buffer.buffer_id
+
+    def window(self):
+        return self.win
+
+    def file_name(self):
+        return self.path
+
+    def settings(self):
+        return self.view_settings
+
+    def change_count(self):
+        return self.changes
+
+    def is_loading(self):
+        return False
+
+    # reading
+
+    def size(self):
+        return len(self.text)
+
+    def line_starts(self):
+        if self.starts is None:
+            starts = [0]
+            find = self.text.find
+            i = find('\n')
+            while i != -1:
+                starts.append(i + 1)
+                i = find('\n', i + 1)
+            self.starts = starts
+        return self.starts
+
+    def substr(self, x):
+        if isinstance(x, Region):
+            return self.text[x.begin():x.end()]
+        return self.text[x:x + 1]
+
+    def rowcol(self, point):
+        starts = self.line_starts()
+        row = bisect.bisect_right(starts, point) - 1
+        return row, point - starts[row]
+
+    def text_point(self, row, col):
+        starts = self.line_starts()
+        row = max(0, min(row, len(starts) - 1))
+        return min(starts[row] + col, len(self.text))
+
+    def line(self, x):
+        if isinstance(x, Region):
+            a = self.line(x.begin()).a
+            b = self.line(x.end()).b
+            return Region(a, b)
+
+        starts = self.line_starts()
+        row = bisect.bisect_right(starts, x) - 1
+        a = starts[row]
+        b = starts[row + 1] - 1 if row + 1 < len(starts) else len(self.text)
+        return Region(a, b)
+
+    def full_line(self, x):
+        line = self.line(x)
+        return Region(line.a, min(line.b + 1, len(self.text)))
+
+    def lines(self, region):
+        ret = []
+        point = region.begin()
+        while True:
+            line = self.line(point)
+            ret.append(line)
+            if line.b >= region.end() or line.b >= len(self.text):
+                return ret
+            point = line.b + 1
+
+    # editing
+
+    def notify(self, a, b, text):
+        if not self.listeners:
+            return
+
+        change = TextChange(Position(a, *self.rowcol(a)), Position(b, *self.rowcol(b)), text)
+        return change
+
+    def apply(self, a, b, text):
+        change = self.notify(a, b, text)
+
+        self.text = self.text[:a] + text + self.text[b:]
+        self.starts = None
+        self.changes += 1
+
+        delta = len(text) - (b - a)
+        erased_end = b if b > a else None
+
+        def move(region):
+            region.a = shift(region.a, a, delta, erased_end)
+            region.b = shift(region.b, a, delta, erased_end)
+
+        for regions, _ in self.regions.values():
+            for region in regions:
+                move(region)
+        for region in self.selection.regions:
+            move(region)
+        for region in self.folds:
+            move(region)
+
+        if change is not None:
+            for listener in self.listeners:
+                listener.on_text_changed([change])
+
+        return len(text)
+
+    def insert(self, edit, point, text):
+        return self.apply(point, point, text)
+
+    def erase(self, edit, region):
+        self.apply(region.begin(), region.end(), '')
+
+    def replace(self, edit, region, text):
+        self.apply(region.begin(), region.end(), text)
+
+    def sel(self):
+        return self.selection
+
+    def run_command(self, cmd, args=None):
+        import sublime_plugin
+        sublime_plugin.run_text_command(self, cmd, args or {})
+
+    def set_read_only(self, value):
+        pass
+
+    def set_scratch(self, value):
+        pass
+
+    def set_name(self, name):
+        pass
+
+    # regions and folds
+
+    def add_regions(self, key, regions, scope='', icon='', flags=0):
+        self.regions[key] = ([Region(r.a, r.b) for r in regions], flags)
+
+    def get_regions(self, key):
+        regions, _ = self.regions.get(key, ([], 0))
+        return [Region(r.a, r.b) for r in regions]
+
+    def erase_regions(self, key):
+        self.regions.pop(key, None)
+
+    def fold(self, region):
+        self.folds.append(Region(region.a, region.b))
+        return True
+
+    def unfold(self, region):
+        self.folds = [r for r in self.folds if not r.intersects(region)]
+        return []
+
+    # scrolling
+
+    def show(self, x, show_surrounds=True):
+        pass
+
+    def show_at_center(self, x):
+        pass
+
+    def visible_region(self):
+        return Region(0, len(self.text))
+
+class Window:
+    def __init__(self):
+        self.window_id = next(ids)
+        self.views = []
+        self.panels = {}
+        self.opened = []
+
+    def id(self):
+        return self.window_id
+
+    def new_file(self):
+        view = View(window=self)
+        self.views.append(view)
+        return view
+
+    def open_file(self, path, flags=0):
+        self.opened.append(path)
+        view = View(window=self)
+        view.path = path
+        return view
+
+    def active_view(self):
+        return self.views[-1] if self.views else None
+
+    def create_output_panel(self, name):
+        panel = View(window=self)
+        self.panels[name] = panel
+        return panel
+
+    def run_command(self, cmd, args=None):
+        pass
+
+    def show_quick_panel(self, items, on_select, flags=0, selected_index=-1):
+        pass
+
+window = Window()
+
+def active_window():
+    return window
+
+def windows():
+    return [window]
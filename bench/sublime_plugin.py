@@ -0,0 +1,72 @@
+# sublime_plugin.py
+# stand-in for Sublime Text's plugin base classes, see sublime.py
+
+import re
+
+text_commands = {}
+window_commands = {}
+text_change_listeners = []
+
+def command_name(cls):
+    name = cls.__name__
+    if name.endswith('Command'):
+        name = name[:-len('Command')]
+    return re.sub(r'(?<=[a-z0-9])([A-Z])', r'_\1', name).lower()
+
+class Command:
+    def is_enabled(self, *args, **kwargs):
+        return True
+
+class TextCommand(Command):
+    def __init__(self, view):
+        self.view = view
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        text_commands[command_name(cls)] = cls
+
+class WindowCommand(Command):
+    def __init__(self, window):
+        self.window = window
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        window_commands[command_name(cls)] = cls
+
+class EventListener:
+    pass
+
+class ViewEventListener:
+    def __init__(self, view):
+        self.view = view
+
+class TextChangeListener:
+    buffer = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        text_change_listeners.append(cls)
+
+    @classmethod
+    def is_applicable(cls, buffer):
+        return False
+
+    def on_text_changed(self, changes):
+        pass
+
+class Edit:
+    pass
+
+def run_text_command(view, name, args):
+    cls = text_commands.get(name)
+    if cls is None:
+        return
+
+    cmd = cls(view)
+    if cmd.is_enabled():
+        cmd.run(Edit(), **args)
+
+def run_window_command(window, name, args):
+    cls = window_commands.get(name)
+    if cls is not None:
+        cls(window).run(**args)
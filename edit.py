@@ -1,9 +1,13 @@
 # edit.py
 # buffer editing for both ST2 and ST3 that "just works"
 
+from contextlib import contextmanager
 import inspect
 import sublime
 import sublime_plugin
+import threading
+
+from .lib.timing import span
 
 try:
     sublime.sublimexiki_edit_storage
@@ -27,6 +31,12 @@ class EditFuture:
 
 
 class EditStep:
+    funcs = {
+        'insert': sublime.View.insert,
+        'erase': sublime.View.erase,
+        'replace': sublime.View.replace,
+    }
+
     def __init__(self, cmd, *args):
         self.cmd = cmd
         self.args = args
@@ -35,15 +45,10 @@ class EditStep:
         if self.cmd == 'callback':
             return run_callback(self.args[0], view, edit)
 
-        funcs = {
-            'insert': view.insert,
-            'erase': view.erase,
-            'replace': view.replace,
-        }
-        func = funcs.get(self.cmd)
+        func = self.funcs.get(self.cmd)
         if func:
             args = self.resolve_args(view, edit)
-            func(edit, *args)
+            func(view, edit, *args)
 
     def resolve_args(self, view, edit):
         args = []
@@ -55,10 +60,33 @@ class EditStep:
 
 
 class Edit:
+    # view id -> (edit, thread) of an open transaction
+    transactions = {}
+
     def __init__(self, view):
         self.view = view
         self.steps = []
 
+    @classmethod
+    @contextmanager
+    def transaction(cls, view, edit):
+        '''
+        Applies every Edit made on view inside the block directly with edit,
+        so one user action across all cursors is a single command run and
+        undo step. Each Edit still applies when its block exits, so later
+        edits see the positions left by earlier ones.
+        '''
+        vid = view.id()
+        outer = cls.transactions.get(vid)
+        cls.transactions[vid] = (edit, threading.current_thread())
+        try:
+            yield
+        finally:
+            if outer is None:
+                del cls.transactions[vid]
+            else:
+                cls.transactions[vid] = outer
+
     def __nonzero__(self):
         return bool(self.steps)
 
@@ -73,6 +101,11 @@ class Edit:
     def insert(self, point, string):
         self.step('insert', point, string)
 
+    def insert_lines(self, point, lines, indent=''):
+        # one step for the whole block instead of one per line
+        sep = '\n' + indent
+        self.step('insert', point, sep + sep.join(lines))
+
     def erase(self, region):
         self.step('erase', region)
 
@@ -96,14 +129,18 @@ class Edit:
 
     def __exit__(self, type, value, traceback):
         view = self.view
-        if sublime.version().startswith('2'):
-            edit = view.begin_edit()
-            self.run(edit)
-            view.end_edit(edit)
-        else:
-            key = str(hash(tuple(self.steps)))
-            sublime.sublimexiki_edit_storage[key] = self.run
-            view.run_command('apply_sublimexiki_edit', {'key': key})
+        with span('edit', view.id()):
+            transaction = self.transactions.get(view.id())
+            if transaction and transaction[1] is threading.current_thread():
+                self.run(view, transaction[0])
+            elif sublime.version().startswith('2'):
+                edit = view.begin_edit()
+                self.run(view, edit)
+                view.end_edit(edit)
+            else:
+                key = str(hash(tuple(self.steps)))
+                sublime.sublimexiki_edit_storage[key] = self.run
+                view.run_command('apply_sublimexiki_edit', {'key': key})
 
 
 class apply_sublimexiki_edit(sublime_plugin.TextCommand):
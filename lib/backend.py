@@ -0,0 +1,139 @@
+# backend.py
+# long-lived xiki worker processes speaking line-delimited JSON
+#
+# each request is one line on the worker's stdin:
+#   {"id": 1, "path": "docs/faq"}
+# and gets one line back on its stdout:
+#   {"id": 1, "output": "..."} or {"id": 1, "error": "..."}
+
+import itertools
+import json
+import queue
+import subprocess
+import threading
+
+from . import util
+
+class BackendError(Exception): pass
+class BackendTimeout(BackendError): pass
+
+class Worker:
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self.p = None
+        self.ids = itertools.count(1)
+
+    def alive(self):
+        return self.p is not None and self.p.poll() is None
+
+    def start(self):
+        p = util.popen(self.cmd, stderr=subprocess.DEVNULL)
+        if not isinstance(p, subprocess.Popen):
+            raise BackendError('could not start %s: %s' % (self.cmd[0], p))
+
+        self.p = p
+
+    def stop(self):
+        if self.p is not None:
+            try:
+                self.p.kill()
+                self.p.wait()
+            except OSError:
+                pass
+            self.p = None
+
+    def send(self, path, timeout):
+        if not self.alive():
+            self.start()
+
+        rid = next(self.ids)
+        request = json.dumps({'id': rid, 'path': path}) + '\n'
+        p = self.p
+        expired = threading.Event()
+        def expire():
+            expired.set()
+            p.kill()
+
+        # a worker that hangs is killed, which unblocks readline()
+        timer = threading.Timer(timeout, expire) if timeout else None
+        try:
+            if timer:
+                timer.start()
+            p.stdin.write(request.encode('utf8'))
+            p.stdin.flush()
+            while True:
+                line = p.stdout.readline()
+                if not line:
+                    raise BackendError('worker exited')
+
+                response = json.loads(line.decode('utf8'))
+                if response.get('id') == rid:
+                    break
+        except (OSError, ValueError, BackendError) as err:
+            if expired.is_set():
+                raise BackendTimeout('timed out after %gs' % timeout)
+            raise BackendError(str(err))
+        finally:
+            if timer:
+                timer.cancel()
+
+        if 'error' in response:
+            return 'Error: ' + response['error']
+        return response.get('output', '')
+
+    def request(self, path, timeout=None):
+        try:
+            return self.send(path, timeout)
+        except BackendTimeout:
+            # a retry would just hang for another timeout
+            raise
+        except BackendError:
+            # restart a crashed worker and retry once
+            self.stop()
+            return self.send(path, timeout)
+
+class Backend:
+    def __init__(self, cmd, size=1):
+        self.cmd = list(cmd)
+        self.size = size
+        self.lock = threading.Lock()
+        self.closed = False
+        self.idle = queue.Queue()
+        for i in range(max(size, 1)):
+            self.idle.put(Worker(self.cmd))
+
+    def request(self, path, timeout=None):
+        worker = self.idle.get()
+        if worker is None:
+            # closed, pass it on to the next waiter
+            self.idle.put(None)
+            raise BackendError('backend closed')
+
+        try:
+            return worker.request(path, timeout)
+        except BackendError:
+            worker.stop()
+            raise
+        finally:
+            with self.lock:
+                closed = self.closed
+                if not closed:
+                    self.idle.put(worker)
+            # checked out when the pool was closed
+            if closed:
+                worker.stop()
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+
+        while True:
+            try:
+                worker = self.idle.get(False)
+            except queue.Empty:
+                break
+            if worker is not None:
+                worker.stop()
+
+        # wakes requests waiting for a worker
+        self.idle.put(None)
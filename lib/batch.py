@@ -0,0 +1,241 @@
+# batch.py
+# expands a whole Xiki document outside of Sublime Text, e.g. to render runbooks in CI
+# usage: python3 -m lib.batch [-j 4] [--refresh] [-o out.xiki] runbook.xiki
+
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import os
+import shlex
+import sys
+import time
+
+from . import util
+from .backend import Backend, BackendError
+from .stream import Terminal
+from .supervisor import Supervisor
+from .tree import INDENTATION, TreeIndex, dispatch, nested_lines, resolve
+
+class TextBuffer:
+    '''
+    A Xiki document as plain text, with the tree lookups xiki.py does on a view.
+    '''
+    def __init__(self, text):
+        self.index = TreeIndex(text)
+
+    @property
+    def lines(self):
+        return self.index.lines
+
+    def text(self):
+        return '\n'.join(self.lines)
+
+    def node(self, row):
+        '''
+        Returns (indent, sign, path, tag, tree) for row, like find_tree().
+        '''
+        return resolve(self.index, row)
+
+    def children(self, row):
+        '''
+        Returns the row after the last line indented under row.
+        '''
+        indent = self.index.parse(row)[0] + INDENTATION
+        end = row + 1
+        lines = self.lines
+        while end < len(lines) and (lines[end].startswith(indent) or not lines[end].strip()):
+            end += 1
+        # trailing blank lines belong to whatever comes next
+        while end > row + 1 and not lines[end - 1].strip():
+            end -= 1
+        return end
+
+    def replace(self, row, text):
+        line = self.lines[row]
+        self.index.change(row, 0, row, len(line), text)
+
+    def splice(self, row, end, lines):
+        '''
+        Replaces the lines below row, up to end, with lines.
+        '''
+        last = end - 1
+        text = ''.join('\n' + line for line in lines)
+        self.index.change(row, len(self.lines[row]), last, len(self.lines[last]), text)
+
+class Runner:
+    def __init__(self, jobs=None, timeout=60, page_size=1000, backend=None, depth=1, ignore=()):
+        self.jobs = jobs or os.cpu_count() or 1
+        self.timeout = timeout
+        self.page_size = page_size
+        self.backend = backend
+        self.depth = depth
+        self.ignore = ignore
+        self.supervisor = Supervisor()
+        # scandir calls of recursive listings, apart from the node pool
+        self.scanners = ThreadPoolExecutor(max_workers=self.jobs)
+
+    def plan(self, buf, refresh=False):
+        '''
+        Returns [(row, job)] for the nodes of buf to expand, top to bottom.
+        Nodes below one that will be expanded are left alone, as their lines
+        are about to be replaced.
+        '''
+        jobs = []
+        row = 0
+        while row < len(buf.lines):
+            indent, sign, path, tag, tree = buf.node(row)
+            op, target = dispatch(sign, path, tag, tree)
+            # node() reports paths with a sign of /, so check the line's own
+            sign = buf.index.parse(row)[1]
+            end = buf.children(row)
+            expanded = end > row + 1
+            job = None
+
+            if op == 'command':
+                if refresh or not expanded:
+                    job = self.command_job(target, tag)
+            elif sign == '+' or (sign == '-' and refresh and expanded):
+                if op == 'dir':
+                    job = self.directory_job(target)
+                elif op == 'menu':
+                    job = self.menu_job(target)
+
+            if job is not None:
+                jobs.append((row, job))
+                row = end
+            else:
+                row += 1
+
+        return jobs
+
+    def command_job(self, cwd, tag):
+        def run():
+            if not os.path.isdir(cwd):
+                return ['%s: %s' % (os.strerror(2), cwd)]
+            try:
+                cmd = util.shell_command(tag)
+            except ValueError as err:
+                return [str(err)]
+
+            p = self.supervisor.launch(util.popen, cmd, tag, wall=self.timeout, cwd=cwd)
+            if isinstance(p, str):
+                return ['Error: ' + p]
+
+            # collapse progress bars and drop colors, as the editor does
+            terminal = Terminal()
+            lines = terminal.feed(util.combine_output(p.popen.communicate()))
+            lines += terminal.close()
+            if p.reason:
+                lines.append('killed: ' + p.reason)
+            return lines
+
+        return run
+
+    def directory_job(self, target):
+        def run():
+            listings = util.walk_dir(target, self.depth, None, self.ignore, self.scanners.map)
+            if target in listings:
+                return nested_lines(target, listings, self.page_size, INDENTATION)
+
+            try:
+                util.list_dir(target)
+            except OSError as err:
+                return ['- ' + err.strerror]
+            return []
+
+        return run
+
+    def menu_job(self, tree):
+        def run():
+            if self.backend:
+                try:
+                    out = self.backend.request(tree, self.timeout)
+                except BackendError as err:
+                    out = 'Error: %s' % err
+            else:
+                out = util.communicate(['xiki'] + tree.split(' '), timeout=self.timeout)
+            return out.rstrip('\n').split('\n') if out else []
+
+        return run
+
+    def expand(self, buf, refresh=False):
+        '''
+        Expands every runnable node of buf in place, running up to self.jobs
+        of them at once. Returns the number of nodes expanded.
+        '''
+        jobs = self.plan(buf, refresh)
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            futures = [(row, pool.submit(job)) for row, job in jobs]
+            results = []
+            for row, future in futures:
+                # one failing node shouldn't cost the rest of the document
+                try:
+                    lines = future.result()
+                except Exception as err:
+                    lines = ['Error: %s' % err]
+                results.append((row, lines))
+
+        # bottom-up, so splicing one node's output doesn't move the rest
+        for row, lines in reversed(results):
+            indent, sign, tag = buf.index.parse(row)
+            buf.splice(row, buf.children(row), [indent + INDENTATION + line for line in lines])
+            if sign == '+':
+                buf.replace(row, indent + '- ' + tag)
+
+        return len(results)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python3 -m lib.batch',
+        description='Expand the $ commands, directories and menus of a Xiki document.')
+    parser.add_argument('file', help='Xiki document, or - for stdin')
+    parser.add_argument('-o', '--output', help='write here instead of stdout')
+    parser.add_argument('-i', '--in-place', action='store_true', help='rewrite file')
+    parser.add_argument('-j', '--jobs', type=int, help='nodes to expand at once (default: CPU count)')
+    parser.add_argument('--refresh', action='store_true',
+        help='also rerun commands and relist directories that are already expanded')
+    parser.add_argument('--timeout', type=float, default=60, help='seconds to let each node run')
+    parser.add_argument('--page-size', type=int, default=1000, help='directory entries to list')
+    parser.add_argument('--depth', type=int, default=1, help='levels of subdirectories to list')
+    parser.add_argument('--ignore', action='append', default=[],
+        help='leave names matching this pattern out of listings, can be repeated')
+    parser.add_argument('--backend', help='command line of a xiki backend worker to expand menus with')
+    parser.add_argument('--login-env', action='store_true',
+        help="run commands in the login shell's environment, as the editor does")
+    args = parser.parse_args(argv)
+
+    if args.file == '-':
+        text = sys.stdin.read()
+    else:
+        with open(args.file, encoding='utf8') as f:
+            text = f.read()
+
+    if args.login_env:
+        util.environment.refresh(wait=True)
+    else:
+        util.environment.set(dict(os.environ))
+
+    runner = Runner(args.jobs, args.timeout, args.page_size, depth=args.depth, ignore=args.ignore)
+    backend = None
+    if args.backend:
+        backend = runner.backend = Backend(shlex.split(args.backend), runner.jobs)
+
+    buf = TextBuffer(text)
+    start = time.time()
+    try:
+        count = runner.expand(buf, args.refresh)
+    finally:
+        if backend:
+            backend.close()
+    sys.stderr.write('expanded %i nodes in %.2fs\n' % (count, time.time() - start))
+
+    output = args.output
+    if args.in_place and args.file != '-':
+        output = args.file
+
+    if output:
+        with open(output, 'w', encoding='utf8') as f:
+            f.write(buf.text())
+    else:
+        sys.stdout.write(buf.text())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+# cache.py
+# thread-safe LRU cache with optional per-entry expiry
+
+from collections import OrderedDict
+import functools
+import threading
+import time
+
+# name -> Cache, for reporting
+registry = {}
+
+class Cache:
+    def __init__(self, size=256, ttl=None, name=None):
+        '''
+        size of 0 means unbounded, ttl of None means entries never expire.
+        Named caches are listed in registry.
+        '''
+        self.name = name
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if name:
+            registry[name] = self
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires is None or expires > time.time():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+
+                del self.entries[key]
+
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        expires = time.time() + ttl if ttl is not None else None
+
+        with self.lock:
+            self.entries[key] = (value, expires)
+            self.entries.move_to_end(key)
+            while self.size and len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, match=None):
+        '''
+        Drops every entry, or only those whose key satisfies match(key).
+        Returns the number of entries dropped.
+        '''
+        with self.lock:
+            if match is None:
+                count = len(self.entries)
+                self.entries.clear()
+                return count
+
+            keys = [key for key in self.entries if match(key)]
+            for key in keys:
+                del self.entries[key]
+            return len(keys)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+MISSING = object()
+
+def memoize(f=None, size=256, ttl=None):
+    '''
+    Caches f's return value per arguments in a named Cache. Usable bare
+    (@memoize) or with limits (@memoize(size=64, ttl=30)). The wrapper's
+    cache attribute exposes invalidate() and stats().
+    '''
+    if f is None:
+        return lambda f: memoize(f, size, ttl)
+
+    cache = Cache(size, ttl, name='%s.%s' % (f.__module__, f.__name__))
+
+    @functools.wraps(f)
+    def wrap(*args, **kwargs):
+        key = args
+        if kwargs:
+            key += (MISSING,) + tuple(sorted(kwargs.items()))
+
+        ret = cache.get(key, MISSING)
+        if ret is MISSING:
+            ret = f(*args, **kwargs)
+            cache.set(key, ret)
+
+        return ret
+
+    wrap.cache = cache
+    return wrap
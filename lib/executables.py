@@ -0,0 +1,118 @@
+# executables.py
+# index of the executables on PATH, for which() and command completion
+
+import bisect
+import os
+import threading
+import time
+
+def can_exec(fpath):
+    return os.path.isfile(fpath) and os.access(fpath, os.X_OK)
+
+def prefix_range(keys, prefix):
+    '''
+    Returns the slice of the sorted list keys that starts with prefix.
+    '''
+    start = bisect.bisect_left(keys, prefix)
+    end = bisect.bisect_left(keys, prefix + '\U0010ffff', start)
+    return keys[start:end]
+
+def scan(directory):
+    names = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file() and os.access(entry.path, os.X_OK):
+                        names.append(entry.name)
+                except OSError:
+                    pass
+    except OSError:
+        pass
+    return names
+
+def mtime(directory):
+    try:
+        return os.stat(directory).st_mtime_ns
+    except OSError:
+        return None
+
+class ExecutableIndex:
+    def __init__(self, check_interval=5.0):
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.thread = None
+        self.path = None
+        self.dirs = {}
+        self.names = {}
+        self.sorted = []
+        self.checked = 0
+
+    def ready(self, path):
+        if path != self.path:
+            self.refresh(path)
+            return False
+
+        if time.time() - self.checked > self.check_interval:
+            self.refresh(path)
+        return True
+
+    def refresh(self, path):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self.build, args=(path,), name='SublimeXiki executables')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def build(self, path):
+        try:
+            dirs = {}
+            for directory in path.split(os.pathsep):
+                if not directory or directory in dirs:
+                    continue
+
+                current = mtime(directory)
+                cached = self.dirs.get(directory)
+                if cached and cached[0] == current:
+                    dirs[directory] = cached
+                else:
+                    dirs[directory] = (current, scan(directory))
+
+            names = {}
+            for directory, (_, entries) in dirs.items():
+                for name in entries:
+                    # earlier PATH entries win, like the shell
+                    names.setdefault(name, os.path.join(directory, name))
+
+            with self.lock:
+                self.dirs = dirs
+                self.names = names
+                self.sorted = sorted(names)
+                self.path = path
+                self.checked = time.time()
+        finally:
+            with self.lock:
+                self.thread = None
+
+    def which(self, cmd, path):
+        if os.path.isabs(cmd):
+            return cmd if can_exec(cmd) else None
+
+        if os.path.basename(cmd) == cmd and self.ready(path):
+            found = self.names.get(cmd)
+            if found is None or can_exec(found):
+                return found
+
+        for base in path.split(os.pathsep):
+            target = os.path.join(base, cmd)
+            if can_exec(target):
+                return target
+
+        return None
+
+    def complete(self, prefix, path):
+        if not self.ready(path):
+            return []
+
+        return prefix_range(self.sorted, prefix)
@@ -0,0 +1,202 @@
+# reactor.py
+# one shared I/O thread multiplexing the output of every spawned command
+
+import os
+import selectors
+import threading
+import time
+import traceback
+
+CHUNK_SIZE = 64 * 1024
+
+class Reactor:
+    def __init__(self, frame=0.05):
+        self.frame = frame
+        self.lock = threading.Lock()
+        self.thread = None
+        self.selector = None
+        self.running = False
+        self.pending = []
+        self.paused = {}
+        self.blocking = {}
+        self.scheduled = []
+        self.last_frame = 0
+        self.wake_r = self.wake_w = None
+
+    def start(self):
+        with self.lock:
+            if self.running:
+                return
+
+            self.selector = selectors.DefaultSelector()
+            self.wake_r, self.wake_w = os.pipe()
+            os.set_blocking(self.wake_r, False)
+            os.set_blocking(self.wake_w, False)
+            self.selector.register(self.wake_r, selectors.EVENT_READ)
+
+            self.running = True
+            self.thread = threading.Thread(target=self.loop, name='SublimeXiki reactor',
+                args=(self.selector, self.wake_r, self.wake_w))
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        '''
+        Stops the I/O thread. Readers still registered are kept, and added
+        back by the next start().
+        '''
+        with self.lock:
+            if not self.running:
+                return
+            self.running = False
+
+        self.wake()
+
+    def wake(self):
+        try:
+            os.write(self.wake_w, b'\0')
+        except (OSError, TypeError):
+            pass
+
+    def add_reader(self, fd, callback):
+        '''
+        Calls callback(data) from the reactor thread whenever fd has output,
+        and callback(b'') once when fd reaches EOF.
+        '''
+        if os.name == 'nt':
+            # select() can't wait on pipes on Windows
+            event = self.blocking[fd] = threading.Event()
+            event.set()
+            thread = threading.Thread(target=self.read_blocking, args=(fd, callback, event))
+            thread.daemon = True
+            thread.start()
+            return
+
+        self.command('add', fd, callback)
+
+    def pause(self, fd):
+        '''
+        Stops reading from fd until resume() is called.
+        '''
+        if fd in self.blocking:
+            self.blocking[fd].clear()
+        else:
+            self.command('pause', fd)
+
+    def resume(self, fd):
+        if fd in self.blocking:
+            self.blocking[fd].set()
+        else:
+            self.command('resume', fd)
+
+    def command(self, *args):
+        self.start()
+        with self.lock:
+            self.pending.append(args)
+        self.wake()
+
+    def schedule(self, func):
+        '''
+        Calls func from the reactor thread at the next frame boundary.
+        Scheduling the same func more than once per frame only calls it once.
+        '''
+        self.start()
+        with self.lock:
+            if func in self.scheduled:
+                return
+            self.scheduled.append(func)
+        self.wake()
+
+    def read_blocking(self, fd, callback, event):
+        while True:
+            event.wait()
+            try:
+                data = os.read(fd, CHUNK_SIZE)
+            except OSError:
+                data = b''
+
+            self.call(callback, data)
+            if not data:
+                self.blocking.pop(fd, None)
+                break
+
+    def call(self, func, *args):
+        try:
+            func(*args)
+        except Exception:
+            print(traceback.format_exc())
+
+    def read(self, selector, key):
+        try:
+            data = os.read(key.fd, CHUNK_SIZE)
+        except OSError:
+            # a pty master raises EIO once the child side is closed
+            data = b''
+
+        if not data:
+            selector.unregister(key.fd)
+
+        self.call(key.data, data)
+
+    def run_command(self, selector, cmd, fd, callback=None):
+        if cmd == 'add':
+            selector.register(fd, selectors.EVENT_READ, callback)
+        elif cmd == 'pause':
+            try:
+                key = selector.unregister(fd)
+            except KeyError:
+                return
+            self.paused[fd] = key.data
+        elif cmd == 'resume':
+            callback = self.paused.pop(fd, None)
+            if callback is not None:
+                selector.register(fd, selectors.EVENT_READ, callback)
+
+    def timeout(self):
+        if not self.scheduled:
+            return None
+
+        return max(0, self.last_frame + self.frame - time.time())
+
+    def run_frame(self):
+        with self.lock:
+            scheduled, self.scheduled = self.scheduled, []
+
+        self.last_frame = time.time()
+        for func in scheduled:
+            self.call(func)
+
+    def loop(self, selector, wake_r, wake_w):
+        while self.running and self.thread is threading.current_thread():
+            with self.lock:
+                pending, self.pending = self.pending, []
+                timeout = self.timeout()
+
+            for args in pending:
+                self.run_command(selector, *args)
+
+            for key, events in selector.select(timeout):
+                if key.fd == wake_r:
+                    try:
+                        while os.read(wake_r, 4096):
+                            pass
+                    except OSError:
+                        pass
+                else:
+                    self.read(selector, key)
+
+            if self.scheduled and self.timeout() == 0:
+                self.run_frame()
+
+        with self.lock:
+            # hand live readers over to the next loop, e.g. across a plugin reload
+            readers = [('add', key.fd, key.data) for key in selector.get_map().values()
+                if key.fd != wake_r]
+            self.pending = readers + self.pending
+            restarted = self.running
+        if restarted:
+            self.wake()
+
+        selector.close()
+        os.close(wake_r)
+        os.close(wake_w)
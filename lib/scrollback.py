@@ -0,0 +1,84 @@
+# scrollback.py
+# bounded record of the command output currently shown in a view
+
+from collections import deque
+import os
+import tempfile
+
+class Scrollback:
+    def __init__(self, max_lines=0, max_chars=0, spill=False, overhead=1):
+        '''
+        max_lines/max_chars of 0 mean unlimited. overhead is the number of
+        characters each line takes up in the view beyond its text
+        (indentation plus the newline).
+        '''
+        self.max_lines = max_lines
+        self.max_chars = max_chars
+        self.spill = spill
+        self.overhead = overhead
+        self.lines = deque()
+        self.size = 0
+        self.trimmed = 0
+        self.path = None
+        self.fd = None
+
+    def full(self):
+        if len(self.lines) <= 1:
+            return False
+
+        return (self.max_lines and len(self.lines) > self.max_lines or
+                self.max_chars and self.size > self.max_chars)
+
+    def extend(self, lines):
+        '''
+        Records lines about to be appended to the view. Returns a tuple of
+        (chars, lines): the number of characters to erase from the top of
+        the output, and the subset of lines that should actually be
+        inserted (the head of a huge batch can overflow the cap itself).
+        '''
+        shown = len(self.lines)
+        for line in lines:
+            self.lines.append(line)
+            self.size += len(line) + self.overhead
+
+        trimmed = []
+        chars = 0
+        while self.full():
+            line = self.lines.popleft()
+            size = len(line) + self.overhead
+            self.size -= size
+            if len(trimmed) < shown:
+                chars += size
+            trimmed.append(line)
+
+        if trimmed:
+            self.trimmed += len(trimmed)
+            self.write(trimmed)
+
+        skip = max(0, len(trimmed) - shown)
+        if skip:
+            lines = lines[skip:]
+        return chars, lines
+
+    def write(self, lines):
+        if not self.spill:
+            return
+
+        if self.fd is None:
+            fd, self.path = tempfile.mkstemp(prefix='xiki-', suffix='.log')
+            self.fd = os.fdopen(fd, 'w', encoding='utf8')
+
+        self.fd.write('\n'.join(lines) + '\n')
+        self.fd.flush()
+
+    def close(self, delete=False):
+        if self.fd is not None:
+            self.fd.close()
+            self.fd = None
+
+        if delete and self.path:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+            self.path = None
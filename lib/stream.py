@@ -0,0 +1,189 @@
+# stream.py
+# turns raw command output into lines, the way a terminal would have shown them
+
+import re
+
+# CSI sequences with their parameters and final byte, OSC strings up to BEL
+# or ST, two byte escapes, and the C0 controls a terminal doesn't print
+control_re = re.compile(
+    r'\x1b\[([0-?]*)[ -/]*([@-~])'
+    r'|\x1b\][^\x07\x1b]*(?:\x07|\x1b\\)'
+    r'|\x1b([ -~])'
+    r'|([\r\n\b\x00-\x08\x0b-\x1f\x7f])'
+)
+# the start of an escape sequence cut off at the end of a chunk
+partial_re = re.compile(r'\x1b(?:\[[0-?]*[ -/]*|\][^\x07\x1b]*\x1b?)?$')
+# anything other than printable text, tabs and newlines
+special_re = re.compile(r'[\x00-\x08\x0b-\x1f\x7f]')
+
+class Terminal:
+    '''
+    A small line discipline emulator. Carriage returns, backspaces, cursor
+    movement and erase sequences rewrite the last height rows in place, and
+    colors and other escapes are dropped, so a progress bar redrawn a
+    thousand times ends up as one line.
+
+    feed() returns the rows that scrolled out of reach of the cursor, which
+    can't change any more. screen() returns the rows that still can. With a
+    width, longer rows wrap, so a huge line is returned in pieces as it
+    arrives instead of being redrawn until it ends.
+    '''
+    def __init__(self, height=24, width=None):
+        self.height = height
+        self.width = width
+        self.rows = ['']
+        self.row = 0
+        self.col = 0
+        self.saved = (0, 0)
+        self.pending = ''
+
+    def feed(self, text):
+        '''
+        Applies decoded output text and returns the list of finished lines.
+        '''
+        if self.pending:
+            text = self.pending + text
+            self.pending = ''
+
+        match = partial_re.search(text, max(0, text.rfind('\x1b')))
+        if match:
+            self.pending = text[match.start():]
+            text = text[:match.start()]
+
+        rows = self.rows
+        if (self.row == len(rows) - 1 and self.col == len(rows[-1])
+                and not special_re.search(text)):
+            # plain lines written at the end, the common case
+            lines = text.split('\n')
+            lines[0] = rows.pop() + lines[0]
+            width = self.width
+            if width and any(len(line) > width for line in lines):
+                lines = [line[i:i + width] for line in lines
+                    for i in range(0, max(len(line), 1), width)]
+            rows.extend(lines)
+            self.row = len(rows) - 1
+            self.col = len(rows[-1])
+            return self.scroll()
+
+        done = []
+        pos = 0
+        for match in control_re.finditer(text):
+            if match.start() > pos:
+                self.write(text[pos:match.start()], done)
+            pos = match.end()
+
+            csi, final, esc, ctl = match.groups()
+            if ctl is not None:
+                if ctl == '\n':
+                    self.newline(done)
+                elif ctl == '\r':
+                    self.col = 0
+                elif ctl == '\b':
+                    self.col = max(0, self.col - 1)
+            elif final is not None:
+                self.csi(csi, final)
+            elif esc == '7':
+                self.saved = (self.row, self.col)
+            elif esc == '8':
+                self.row = min(self.saved[0], len(self.rows) - 1)
+                self.col = self.saved[1]
+
+        if pos < len(text):
+            self.write(text[pos:], done)
+        return done
+
+    def write(self, s, done):
+        width = self.width
+        while width and self.col + len(s) > width:
+            room = max(width - self.col, 0)
+            self.put(s[:room])
+            s = s[room:]
+            self.newline(done)
+        self.put(s)
+
+    def put(self, s):
+        line = self.rows[self.row]
+        col = self.col
+        if col > len(line):
+            line += ' ' * (col - len(line))
+        self.rows[self.row] = line[:col] + s + line[col + len(s):]
+        self.col = col + len(s)
+
+    def newline(self, done):
+        self.row += 1
+        self.col = 0
+        if self.row == len(self.rows):
+            self.rows.append('')
+            done.extend(self.scroll())
+
+    def scroll(self):
+        '''
+        Drops and returns the rows above the top of the screen.
+        '''
+        extra = len(self.rows) - self.height
+        if extra <= 0:
+            return []
+        done = self.rows[:extra]
+        del self.rows[:extra]
+        self.row -= extra
+        self.saved = (max(0, self.saved[0] - extra), self.saved[1])
+        return done
+
+    def csi(self, params, final):
+        args = [int(arg) if arg.isdigit() else 0 for arg in params.split(';')]
+        n = max(args[0], 1)
+        last = len(self.rows) - 1
+        if final == 'A':
+            self.row = max(0, self.row - n)
+        elif final == 'B':
+            self.row = min(last, self.row + n)
+        elif final == 'C':
+            self.col += n
+        elif final == 'D':
+            self.col = max(0, self.col - n)
+        elif final == 'E':
+            self.row = min(last, self.row + n)
+            self.col = 0
+        elif final == 'F':
+            self.row = max(0, self.row - n)
+            self.col = 0
+        elif final == 'G':
+            self.col = n - 1
+        elif final in 'Hf':
+            self.row = min(last, n - 1)
+            self.col = max(args[1] if len(args) > 1 else 1, 1) - 1
+        elif final == 'K':
+            line = self.rows[self.row]
+            if args[0] == 0:
+                self.rows[self.row] = line[:self.col]
+            elif args[0] == 1:
+                self.rows[self.row] = ' ' * self.col + line[self.col:]
+            else:
+                self.rows[self.row] = ''
+        elif final == 'J':
+            if args[0] == 0:
+                self.rows[self.row] = self.rows[self.row][:self.col]
+                del self.rows[self.row + 1:]
+            else:
+                self.rows = ['']
+                self.row = self.col = 0
+
+    def screen(self):
+        '''
+        Returns the rows that can still be rewritten, without the empty row
+        after a trailing newline.
+        '''
+        rows = self.rows
+        if not rows[-1] and self.row == len(rows) - 1:
+            rows = rows[:-1]
+        return list(rows)
+
+    def close(self):
+        '''
+        Returns the remaining rows as finished lines.
+        '''
+        self.pending = ''
+        lines = self.screen()
+        self.rows = ['']
+        self.row = self.col = 0
+        return lines
@@ -0,0 +1,22 @@
+# stub_worker.py
+# stand-in xiki backend worker for exercising the protocol without xiki
+# usage: "xiki_backend": ["python3", "/path/to/SublimeXiki/lib/stub_worker.py"]
+
+import json
+import sys
+
+def main():
+    for line in sys.stdin:
+        request = json.loads(line)
+        path = request.get('path', '')
+        if path == 'crash':
+            sys.exit(1)
+
+        parts = [part for part in path.split('/') if part]
+        output = ''.join('+ %s\n' % part for part in parts)
+        response = {'id': request.get('id'), 'output': output}
+        sys.stdout.write(json.dumps(response) + '\n')
+        sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,257 @@
+# supervisor.py
+# owns spawned commands: process groups, kill escalation, reaping and resource limits
+
+import os
+import signal
+import threading
+import time
+import traceback
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+PROC = '/proc'
+
+def clock_ticks():
+    try:
+        return os.sysconf('SC_CLK_TCK')
+    except (AttributeError, ValueError, OSError):
+        return 100
+
+def page_size():
+    try:
+        return os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return 4096
+
+def sample_groups(pgids):
+    '''
+    Returns {pgid: (cpu seconds, rss bytes)} summed over every live process in
+    each of pgids, or None where /proc isn't available.
+    '''
+    if not os.path.isdir(PROC):
+        return None
+
+    ticks = clock_ticks()
+    pagesize = page_size()
+    usage = dict((pgid, [0.0, 0]) for pgid in pgids)
+    try:
+        pids = [name for name in os.listdir(PROC) if name.isdigit()]
+    except OSError:
+        return None
+
+    for pid in pids:
+        try:
+            with open(os.path.join(PROC, pid, 'stat'), 'rb') as f:
+                stat = f.read()
+        except OSError:
+            continue
+
+        # the command name can contain spaces and parens, so split after it
+        fields = stat[stat.rfind(b')') + 2:].split()
+        try:
+            pgid = int(fields[2])
+            entry = usage.get(pgid)
+            if entry is not None:
+                entry[0] += (int(fields[11]) + int(fields[12])) / ticks
+                entry[1] += int(fields[21]) * pagesize
+        except (IndexError, ValueError):
+            continue
+
+    return dict((pgid, tuple(entry)) for pgid, entry in usage.items())
+
+def rlimits(cpu, memory):
+    '''
+    Returns a preexec_fn applying per-process kernel limits, for platforms
+    where sample_groups() can't see the whole group.
+    '''
+    def apply():
+        if cpu:
+            resource.setrlimit(resource.RLIMIT_CPU, (int(cpu), int(cpu) + 1))
+        if memory:
+            resource.setrlimit(resource.RLIMIT_AS, (int(memory), int(memory)))
+    return apply
+
+class Process:
+    def __init__(self, popen, cmd, name, cpu=None, memory=None, wall=None):
+        self.popen = popen
+        self.pid = popen.pid
+        self.cmd = cmd
+        self.name = name
+        self.cpu_limit = cpu
+        self.memory_limit = memory
+        self.wall_limit = wall
+        self.started = time.time()
+        self.cpu = None
+        self.rss = None
+        # set once the process has been asked to stop
+        self.stopping = None
+        self.kill_at = None
+        # why the supervisor stopped it, if it did
+        self.reason = None
+
+    @property
+    def elapsed(self):
+        return time.time() - self.started
+
+    @property
+    def returncode(self):
+        return self.popen.returncode
+
+    def poll(self):
+        return self.popen.poll()
+
+    def signal(self, sig):
+        if os.name == 'nt':
+            if sig == getattr(signal, 'SIGKILL', None):
+                self.popen.kill()
+            else:
+                self.popen.terminate()
+        else:
+            os.killpg(self.pid, sig)
+
+class Supervisor:
+    def __init__(self, grace=2.0, interval=0.5, sample_interval=5.0):
+        '''
+        grace is how long a stopped command gets between SIGTERM and SIGKILL.
+        interval is how often processes are reaped and their limits checked.
+        sample_interval is how often CPU and memory use is read when no
+        process has a limit on them.
+        '''
+        self.grace = grace
+        self.interval = interval
+        self.sample_interval = sample_interval
+        self.sampled = 0
+        self.lock = threading.Lock()
+        self.processes = {}
+        self.thread = None
+        self.wakeup = threading.Event()
+
+    def launch(self, popen, cmd, name, cpu=None, memory=None, wall=None, **kwargs):
+        '''
+        Starts cmd with popen(cmd, group=True, ...) and supervises it.
+        Returns a Process, or whatever popen returned if it failed.
+        '''
+        preexec_fn = None
+        if (cpu or memory) and resource is not None and not os.path.isdir(PROC):
+            preexec_fn = rlimits(cpu, memory)
+
+        p = popen(cmd, group=True, preexec_fn=preexec_fn, **kwargs)
+        if not hasattr(p, 'pid'):
+            return p
+
+        proc = Process(p, cmd, name, cpu, memory, wall)
+        with self.lock:
+            self.processes[proc.pid] = proc
+        self.start()
+        return proc
+
+    def running(self):
+        with self.lock:
+            return sorted(self.processes.values(), key=lambda proc: proc.started)
+
+    def terminate(self, proc, reason=None, grace=None):
+        '''
+        Sends SIGTERM to proc's process group, then SIGKILL if it's still
+        around grace seconds later.
+        '''
+        with self.lock:
+            if proc.pid not in self.processes:
+                return
+            if proc.stopping is None:
+                proc.stopping = time.time()
+                proc.reason = reason
+            proc.kill_at = time.time() + (self.grace if grace is None else grace)
+
+        try:
+            proc.signal(signal.SIGTERM)
+        except OSError:
+            pass
+
+        self.start()
+        self.wakeup.set()
+
+    def kill(self, proc):
+        try:
+            proc.signal(getattr(signal, 'SIGKILL', signal.SIGTERM))
+        except OSError:
+            pass
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None or not self.processes:
+                return
+            self.thread = threading.Thread(target=self.loop, name='SublimeXiki supervisor')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        with self.lock:
+            self.thread = None
+        self.wakeup.set()
+
+    def sample(self, procs=None):
+        '''
+        Reads the CPU and memory use of procs, or of every running process,
+        into their cpu and rss. Returns the sample_groups() result.
+        '''
+        if procs is None:
+            procs = self.running()
+        self.sampled = time.time()
+        usage = sample_groups([proc.pid for proc in procs if os.name != 'nt'])
+        if usage is not None:
+            for proc in procs:
+                if proc.pid in usage:
+                    proc.cpu, proc.rss = usage[proc.pid]
+        return usage
+
+    def check(self):
+        now = time.time()
+        with self.lock:
+            procs = list(self.processes.values())
+
+        # reading /proc is only worth it every interval while something
+        # depends on it: a limit, or a stopped group that may still be running
+        usage = None
+        if (now - self.sampled >= self.sample_interval
+                or any(proc.cpu_limit or proc.memory_limit or proc.stopping is not None
+                       for proc in procs)):
+            usage = self.sample(procs)
+
+        for proc in procs:
+            exited = proc.poll() is not None
+            if exited and (proc.stopping is None or usage is None or not usage[proc.pid][1]):
+                # reaped, and nothing is left running in its group
+                with self.lock:
+                    self.processes.pop(proc.pid, None)
+                continue
+
+            if proc.stopping is not None:
+                if now >= proc.kill_at:
+                    self.kill(proc)
+                    proc.kill_at = now + self.grace
+                continue
+
+            if proc.wall_limit and proc.elapsed > proc.wall_limit:
+                self.terminate(proc, 'exceeded time limit of %gs' % proc.wall_limit)
+            elif proc.cpu_limit and proc.cpu is not None and proc.cpu > proc.cpu_limit:
+                self.terminate(proc, 'exceeded CPU limit of %gs' % proc.cpu_limit)
+            elif proc.memory_limit and proc.rss is not None and proc.rss > proc.memory_limit:
+                self.terminate(proc, 'exceeded memory limit of %iMB' % (proc.memory_limit // 2**20))
+
+    def loop(self):
+        while self.thread is threading.current_thread():
+            try:
+                self.check()
+            except Exception:
+                print(traceback.format_exc())
+
+            with self.lock:
+                if not self.processes:
+                    self.thread = None
+                    return
+
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
@@ -0,0 +1,139 @@
+# timing.py
+# optional timing spans, aggregated into per-operation latency histograms
+
+import math
+import threading
+import time
+
+# buckets per doubling, so percentiles are accurate to about 19%
+STEPS = 4
+# 1us up to about 70 minutes
+BUCKETS = 32 * STEPS
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        micros = seconds * 1e6
+        if micros > 1:
+            i = min(int(math.log2(micros) * STEPS) + 1, BUCKETS - 1)
+        else:
+            i = 0
+        self.counts[i] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p):
+        '''
+        Returns the upper bound in seconds of the bucket holding the pth
+        percentile, capped at the largest sample.
+        '''
+        if not self.count:
+            return 0.0
+
+        rank = p / 100.0 * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(2 ** (i / STEPS) / 1e6, self.max)
+        return self.max
+
+class Span:
+    __slots__ = ('timings', 'name', 'view', 'start')
+
+    def __init__(self, timings, name, view):
+        self.timings = timings
+        self.name = name
+        self.view = view
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.timings.record(self.name, time.perf_counter() - self.start, self.view)
+
+class NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+null_span = NullSpan()
+
+class Timings:
+    def __init__(self):
+        self.enabled = False
+        # seconds, operations slower than this are logged
+        self.slow = None
+        self.lock = threading.Lock()
+        self.histograms = {}
+
+    def span(self, name, view=None):
+        '''
+        Times a with block as operation name, in the view with id view.
+        Does nothing unless enabled.
+        '''
+        if not self.enabled and self.slow is None:
+            return null_span
+        return Span(self, name, view)
+
+    def record(self, name, seconds, view=None):
+        if self.slow is not None and seconds >= self.slow:
+            print('SublimeXiki: slow %s took %.1fms' % (name, seconds * 1000))
+
+        if not self.enabled:
+            return
+
+        key = (name, view)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.add(seconds)
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+
+    def stats(self):
+        '''
+        Returns [(name, view, histogram)] sorted by name, with a row per view
+        after a row with a view of None holding the totals.
+        '''
+        with self.lock:
+            items = list(self.histograms.items())
+
+        totals = {}
+        rows = []
+        for (name, view), histogram in items:
+            total = totals.get(name)
+            if total is None:
+                total = totals[name] = Histogram()
+                rows.append((name, None, total))
+            total.merge(histogram)
+            if view is not None:
+                rows.append((name, view, histogram))
+
+        rows.sort(key=lambda row: (row[0], row[1] is not None, row[1] or 0))
+        return rows
+
+timings = Timings()
+span = timings.span
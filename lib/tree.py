@@ -0,0 +1,288 @@
+# tree.py
+# in-memory index of a Xiki buffer's lines and their indentation ancestry
+
+import bisect
+import os
+import platform
+import re
+
+INDENTATION = '  '
+# tag of the node a command's trimmed scrollback can be opened from
+TRIM_MARKER = 'earlier output: '
+
+line_re = re.compile(r'^(\s*)(\$\$|[-+$]\s*)?(.*)$')
+more_re = re.compile(r'^more\.\.\. \(showing (\d+) of \d+\)$')
+
+MISSING = -1
+
+def parse_line(line):
+    '''
+    Returns (indent, sign, tag) for line.
+    '''
+    match = line_re.match(line)
+    return match.group(1), (match.group(2) or '').strip(), match.group(3)
+
+class TreeIndex:
+    def __init__(self, text='', change_count=None):
+        self.change_count = change_count
+        self.reset(text)
+
+    def reset(self, text):
+        self.lines = text.split('\n')
+        self.parsed = [None] * len(self.lines)
+        self.parents = [MISSING] * len(self.lines)
+
+    def __len__(self):
+        return len(self.lines)
+
+    def change(self, row_a, col_a, row_b, col_b, text):
+        '''
+        Replaces the text between (row_a, col_a) and (row_b, col_b) with text,
+        reparsing only the lines it touches.
+        '''
+        if not (0 <= row_a <= row_b < len(self.lines)):
+            raise IndexError('change outside of indexed buffer')
+
+        prefix = self.lines[row_a][:col_a]
+        suffix = self.lines[row_b][col_b:]
+        new = (prefix + text + suffix).split('\n')
+
+        count = len(new)
+        self.lines[row_a:row_b + 1] = new
+        self.parsed[row_a:row_b + 1] = [None] * count
+        # parents of later rows may now point across the change
+        tail = len(self.lines) - row_a
+        self.parents[row_a:] = [MISSING] * tail
+
+    def line(self, row):
+        return self.lines[row]
+
+    def parse(self, row):
+        '''
+        Returns (indent, sign, tag) for row.
+        '''
+        entry = self.parsed[row]
+        if entry is None:
+            entry = self.parsed[row] = parse_line(self.lines[row])
+        return entry
+
+    def parent(self, row):
+        '''
+        Returns the nearest row above row with a shorter indent and a
+        non-empty tag, or None.
+        '''
+        parents = self.parents
+        todo = [row]
+        while todo:
+            r = todo[-1]
+            if parents[r] != MISSING:
+                todo.pop()
+                continue
+
+            indent = len(self.parse(r)[0])
+            result = None
+            blocked = False
+            j = r - 1
+            while j >= 0:
+                other, _, tag = self.parse(j)
+                if not tag:
+                    j -= 1
+                elif len(other) < indent:
+                    result = j
+                    break
+                elif parents[j] == MISSING:
+                    # resolve j's parent first, then come back to r
+                    todo.append(j)
+                    blocked = True
+                    break
+                else:
+                    # nothing between j and its parent is indented less than j
+                    j = parents[j]
+                    if j is None:
+                        break
+
+            if not blocked:
+                parents[r] = result
+                todo.pop()
+
+        return parents[row]
+
+    def ancestors(self, row):
+        '''
+        Yields the ancestor rows of row, nearest first.
+        '''
+        row = self.parent(row)
+        while row is not None:
+            yield row
+            row = self.parent(row)
+
+class ScanIndex:
+    '''
+    The parse() and ancestors() of a TreeIndex, reading each line with
+    get_line(row) as needed instead of indexing the whole buffer. Finding
+    ancestors scans up from the row, so it costs the distance to the root.
+    '''
+    def __init__(self, get_line):
+        self.get_line = get_line
+        self.parsed = {}
+
+    def parse(self, row):
+        entry = self.parsed.get(row)
+        if entry is None:
+            entry = self.parsed[row] = parse_line(self.get_line(row))
+        return entry
+
+    def ancestors(self, row):
+        indent = len(self.parse(row)[0])
+        row -= 1
+        while indent and row >= 0:
+            other, _, tag = self.parse(row)
+            if tag and len(other) < indent:
+                yield row
+                indent = len(other)
+            row -= 1
+
+def resolve(index, row):
+    '''
+    Returns (indent, sign, path, tag, tree) for the node at row: path is the
+    nearest ancestor naming a directory, and tree joins the tags below it.
+    '''
+    line_indent, sign, tag = index.parse(row)
+    tree = [tag]
+    if tag.startswith('/'):
+        sign = '/'
+
+    for ancestor in index.ancestors(row):
+        tree.insert(0, index.parse(ancestor)[2])
+
+    new_tree = []
+    path = None
+    for part in reversed(tree):
+        if part.startswith('@'):
+            new_tree.insert(0, part.strip('@'))
+        elif part.startswith(('/', os.sep)):
+            path = part
+        elif re.match(r'^[A-Z]:\\', part):
+            path = part
+        elif part.startswith('~'):
+            path = os.path.expanduser(part)
+        else:
+            new_tree.insert(0, part)
+            continue
+
+        break
+
+    return line_indent, sign, path, tag, os.sep.join(new_tree).replace(os.sep * 2, os.sep)
+
+def dispatch(sign, path, tag, tree):
+    '''
+    Decides what expanding a node does, given its sign, path, tag and tree
+    as returned by resolve(). Returns (op, target), one of:
+
+      ('trimmed', file)    open output trimmed from a command's scrollback
+      ('more', directory)  list the next page of directory
+      ('command', cwd)     run tag as a command in cwd
+      ('file', file)       open file
+      ('dir', directory)   list directory
+      ('menu', tree)       expand the xiki menu tree
+      (None, None)         nothing to do
+    '''
+    if sign == '-' and tag.startswith(TRIM_MARKER):
+        return 'trimmed', tag[len(TRIM_MARKER):]
+
+    if sign == '+' and path and more_re.match(tag):
+        return 'more', dirname(path, tree, tag)
+
+    if sign in ('$', '$$'):
+        cwd = os.path.expanduser('~')
+        if path:
+            cwd = dirname(path, tree, tag)
+            if platform.system() == 'Windows':
+                cwd = cwd.lstrip('/')
+        return 'command', cwd
+
+    if path:
+        d, f = os.path.split(os.path.join(path, tree))
+        target = os.path.join(d, unslash(f))
+        if os.path.isfile(target):
+            return 'file', target
+        elif os.path.isdir(target):
+            return 'dir', target
+    elif sign != '-' and tree:
+        return 'menu', tree
+
+    return None, None
+
+def slash(s, chars):
+    if re.match(r'^[%s]' % re.escape(chars), s):
+        s = '\\' + s
+
+    return s
+
+def unslash(s):
+    out = ''
+    escaped = False
+    for c in s:
+        if escaped:
+            escaped = False
+            out += c
+        elif c == '\\':
+            escaped = True
+        else:
+            out += c
+
+    return out
+
+def dirname(path, tree, tag):
+    path_re = r'^(.+)%s%s$' % (re.escape(os.sep), re.escape(tag))
+    match = re.match(path_re, tree)
+    if match:
+        return os.path.join(path, match.group(1))
+    else:
+        return path
+
+def listing_lines(dirs, files, offset=0, page_size=1000):
+    '''
+    Returns the node lines for one page of a directory listing, ending in a
+    "more..." node if there are more entries after it.
+    '''
+    total = len(dirs) + len(files)
+    end = offset + page_size
+
+    lines = ['+ %s%s' % (entry, os.sep) for entry in dirs[offset:end]]
+    start = max(offset - len(dirs), 0)
+    lines += [slash(entry, '\\+$-') for entry in files[start:max(end - len(dirs), 0)]]
+    if end < total:
+        lines.append('+ more... (showing %i of %i)' % (end, total))
+
+    return lines
+
+def listing_offset(dirs, files, last):
+    '''
+    Returns the offset of the entry after last in a listing, where last is
+    the line of the last entry already shown, so the next page carries on
+    from it even if entries were added or removed since.
+    '''
+    if last.startswith(('+ ', '- ')) and last.endswith(os.sep):
+        keys = [name.lower() for name in dirs]
+        return bisect.bisect_right(keys, last[2:-len(os.sep)].lower())
+
+    keys = [name.lower() for name in files]
+    return len(dirs) + bisect.bisect_right(keys, unslash(last).lower())
+
+def nested_lines(path, listings, page_size=1000, indent='  '):
+    '''
+    Returns the node lines for the listing of path in listings, as from
+    util.walk_dir(), with every listed subdirectory expanded below its node.
+    '''
+    dirs, files = listings[path]
+    lines = []
+    for i, line in enumerate(listing_lines(dirs, files, 0, page_size)):
+        sub = os.path.join(path, dirs[i]) if i < min(len(dirs), page_size) else None
+        if sub in listings:
+            lines.append('- ' + line[2:])
+            lines.extend(indent + child for child in nested_lines(sub, listings, page_size, indent))
+        else:
+            lines.append(line)
+
+    return lines
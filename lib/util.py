@@ -1,11 +1,23 @@
+import fnmatch
 import os
 import shutil
 import string
 import tempfile
+import threading
 from threading import Timer
+import time
 import shlex
 import subprocess
 
+from .cache import memoize
+from .executables import ExecutableIndex
+# moved to executables.py, kept importable as util.can_exec
+from .executables import can_exec  # noqa: F401
+
+# window size of the pseudo terminal commands run in, the height matches stream.Terminal
+PTY_ROWS = 24
+PTY_COLUMNS = 120
+
 def merge_user_settings(settings):
     default = settings.get('default') or {}
     user = settings.get('user') or {}
@@ -24,25 +36,13 @@ def merge_user_settings(settings):
 
     return default
 
-def memoize(f):
-    rets = {}
-
-    def wrap(*args):
-        if not args in rets:
-            rets[args] = f(*args)
-
-        return rets[args]
-
-    wrap.__name__ = f.__name__
-    return wrap
-
 def climb(top):
     right = True
     while right:
         top, right = os.path.split(top)
         yield top
 
-@memoize
+@memoize(size=1024, ttl=60)
 def find(top, name, parent=False):
     for d in climb(top):
         target = os.path.join(d, name)
@@ -85,24 +85,159 @@ def find_path(env):
 
     return p
 
-@memoize
-def create_environment():
+def resolve_environment():
+    env = dict(os.environ)
     if os.name == 'posix':
-        os.environ['PATH'] = find_path(os.environ)
+        env['PATH'] = find_path(env)
+
+    return env
+
+class Environment:
+    '''
+    The login shell's environment, resolved on a background thread.
+    Until it's ready, and while it's being refreshed, get() falls back
+    to the last resolved environment or os.environ.
+    '''
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self.env = None
+        self.resolved = 0
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def stale(self):
+        if self.env is None:
+            return True
+        return self.ttl is not None and time.time() - self.resolved > self.ttl
+
+    def refresh(self, wait=False):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.resolve, name='SublimeXiki environment')
+                self.thread.daemon = True
+                self.thread.start()
+            thread = self.thread
+
+        if wait:
+            thread.join()
+
+    def resolve(self):
+        try:
+            env = resolve_environment()
+        except Exception as err:
+            print('SublimeXiki: could not resolve login environment:', err)
+            env = dict(os.environ)
+
+        with self.lock:
+            self.env = env
+            self.resolved = time.time()
+            self.thread = None
+
+    def set(self, env):
+        with self.lock:
+            self.env = env
+            self.resolved = time.time()
+
+    def get(self):
+        if self.stale():
+            self.refresh()
+
+        return self.env or os.environ
+
+environment = Environment()
 
-    return os.environ
+def create_environment():
+    return environment.get()
 
-def can_exec(fpath):
-    return os.path.isfile(fpath) and os.access(fpath, os.X_OK)
+executables = ExecutableIndex()
 
 def which(cmd):
     env = create_environment()
-    for base in env.get('PATH', '').split(os.pathsep):
-        path = os.path.join(base, cmd)
-        if can_exec(path):
-            return path
+    return executables.which(cmd, env.get('PATH', ''))
+
+def shell_command(tag, env=None):
+    '''
+    Returns the argv running the command line tag: through $SHELL where it's
+    set, cmd on Windows, or split into words otherwise. Raises ValueError if
+    tag can't be split.
+    '''
+    if env is None:
+        env = create_environment()
 
-    return None
+    shell = env.get('SHELL')
+    if shell and which(shell):
+        return [shell, '-c', tag]
+    elif os.name == 'nt':
+        return ['cmd', '/c', tag]
+    return shlex.split(tag, True)
+
+def complete_command(prefix):
+    env = create_environment()
+    return executables.complete(prefix, env.get('PATH', ''))
+
+def list_dir(path):
+    '''
+    Returns sorted lists of the directory and file names in path, using
+    the entry types from scandir instead of a stat call per entry.
+    '''
+    dirs = []
+    files = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+
+            if is_dir:
+                dirs.append(entry.name)
+            else:
+                files.append(entry.name)
+
+    dirs.sort(key=str.lower)
+    files.sort(key=str.lower)
+    return dirs, files
+
+def walk_dir(root, depth=1, budget=None, ignore=(), map=map, chunk=32):
+    '''
+    Lists root and the directories under it, down to depth levels, skipping
+    names that match any fnmatch pattern in ignore. Each level is listed
+    chunk directories at a time through map, which can be a thread pool's,
+    and nothing more is listed once budget entries have been.
+    Returns {path: (dirs, files)} for every directory listed.
+    '''
+    def scan(path):
+        try:
+            dirs, files = list_dir(path)
+        except OSError:
+            return None
+
+        if ignore:
+            dirs = [d for d in dirs if not any(fnmatch.fnmatch(d, pat) for pat in ignore)]
+            files = [f for f in files if not any(fnmatch.fnmatch(f, pat) for pat in ignore)]
+        return dirs, files
+
+    listings = {}
+    count = 0
+    level = [root]
+    for _ in range(depth):
+        below = []
+        for i in range(0, len(level), chunk):
+            if budget is not None and count >= budget:
+                return listings
+
+            paths = level[i:i + chunk]
+            for path, listing in zip(paths, map(scan, paths)):
+                if listing is not None:
+                    listings[path] = listing
+                    count += len(listing[0]) + len(listing[1])
+                    below.extend(os.path.join(path, d) for d in listing[0])
+
+        level = below
+        if not level:
+            break
+
+    return listings
 
 def touch(path):
     with open(path, 'a'):
@@ -111,29 +246,32 @@ def touch(path):
 # popen methods
 def combine_output(out, sep=''):
     return sep.join((
-        (out[0].decode('utf8') or ''),
-        (out[1].decode('utf8') or ''),
+        (out[0].decode('utf8', errors='replace') or ''),
+        (out[1].decode('utf8', errors='replace') or ''),
     ))
 
 def communicate(cmd, stdin=None, timeout=None, **popen_args):
     p = popen(cmd, **popen_args)
     if isinstance(p, subprocess.Popen):
-        timer = None
-        if timeout is not None:
-            kill = lambda: p.kill()
-            timer = Timer(timeout, kill)
-            timer.start()
-
-        out = p.communicate(stdin)
-        if timer is not None:
-            timer.cancel()
-
-        return combine_output(out)
+        return wait(p, stdin, timeout)
     elif isinstance(p, str):
         return p
     else:
         return ''
 
+def wait(p, stdin=None, timeout=None):
+    timer = None
+    if timeout is not None:
+        kill = lambda: p.kill()
+        timer = Timer(timeout, kill)
+        timer.start()
+
+    out = p.communicate(stdin)
+    if timer is not None:
+        timer.cancel()
+
+    return combine_output(out)
+
 def tmpfile(cmd, code, suffix=''):
     if isinstance(cmd, str):
         cmd = cmd,
@@ -167,8 +305,7 @@ def tmpdir(cmd, files, filename, code):
         else:
             shutil.copyfile(f, target)
 
-    os.chdir(d)
-    out = popen(cmd)
+    out = popen(cmd, cwd=d)
     if out:
         out = out.communicate()
         out = combine_output(out, '\n')
@@ -185,43 +322,63 @@ def tmpdir(cmd, files, filename, code):
     shutil.rmtree(d, True)
     return out
 
-def popen(cmd, env=None, use_pty=False):
+def set_winsize(fd, rows, columns):
+    import fcntl, struct, termios
+    fcntl.ioctl(fd, termios.TIOCSWINSZ, struct.pack('HHHH', rows, columns, 0, 0))
+
+def popen(cmd, env=None, use_pty=False, stderr=subprocess.PIPE, cwd=None, group=False, preexec_fn=None):
+    '''
+    With group=True, the command leads a new process group (a new session on
+    posix), so it can be signalled together with everything it spawns.
+    With use_pty=True, stdin, stdout and stderr are the slave side of a new
+    pseudo terminal, and p.stdout reads everything the command writes.
+    '''
     if isinstance(cmd, str):
         cmd = cmd,
 
     stdin = subprocess.PIPE
     stdout = subprocess.PIPE
-    stderr = subprocess.PIPE
 
     master = None
     info = None
+    flags = 0
     if os.name == 'nt':
         info = subprocess.STARTUPINFO()
         info.dwFlags |= subprocess.STARTF_USESHOWWINDOW
         info.wShowWindow = subprocess.SW_HIDE
+        if group:
+            flags = subprocess.CREATE_NEW_PROCESS_GROUP
     elif use_pty:
         import pty
         master, slave = pty.openpty()
-        stdin = slave
-        stdout = slave
+        set_winsize(slave, PTY_ROWS, PTY_COLUMNS)
+        stdin = stdout = stderr = slave
 
     if env is None:
         env = create_environment()
+    if master is not None and not 'TERM' in env:
+        env = dict(env, TERM='xterm')
 
     try:
         p = subprocess.Popen(cmd, stdin=stdin,
             stdout=stdout, stderr=stderr,
-            startupinfo=info, env=env)
+            startupinfo=info, env=env, cwd=cwd, creationflags=flags,
+            start_new_session=group and os.name != 'nt', preexec_fn=preexec_fn)
 
-        if master:
+        if master is not None:
+            # the child has its own copy, and the master only sees EOF once all are closed
+            os.close(slave)
             p.pty = True
-            p.stdout = os.fdopen(master, 'rb')
-            p.stdin = os.fdopen(master, 'wb')
+            p.stdout = os.fdopen(master, 'rb', buffering=0)
+            p.stdin = os.fdopen(os.dup(master), 'wb', buffering=0)
         else:
             p.pty = False
 
         return p
     except OSError as err:
+        if master is not None:
+            os.close(master)
+            os.close(slave)
         print('Error launching', repr(cmd))
         print('Error was:', err.strerror)
         print('Environment:', env)
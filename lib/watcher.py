@@ -0,0 +1,205 @@
+# watcher.py
+# notices when watched directories gain or lose entries
+# uses inotify on Linux, and polls directory mtimes everywhere else
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import threading
+import time
+import traceback
+
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_MASK = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+event_header = struct.Struct('iIII')
+
+class Inotify:
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.libc = libc
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.wds = {}
+        self.paths = {}
+
+    def add(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), IN_MASK)
+        if wd >= 0:
+            self.wds[path] = wd
+            self.paths[wd] = path
+
+    def remove(self, path):
+        wd = self.wds.pop(path, None)
+        if wd is not None:
+            self.paths.pop(wd, None)
+            self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout):
+        '''
+        Waits up to timeout seconds and returns the set of changed paths.
+        '''
+        changed = set()
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return changed
+
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError:
+            return changed
+
+        offset = 0
+        while offset + event_header.size <= len(data):
+            wd, mask, cookie, length = event_header.unpack_from(data, offset)
+            offset += event_header.size + length
+            path = self.paths.get(wd)
+            if path is not None:
+                changed.add(path)
+
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+class Poller:
+    def __init__(self, interval):
+        self.interval = interval
+        self.mtimes = {}
+
+    def stat(self, path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    def add(self, path):
+        self.mtimes[path] = self.stat(path)
+
+    def remove(self, path):
+        self.mtimes.pop(path, None)
+
+    def read(self, timeout):
+        time.sleep(min(timeout, self.interval) if timeout is not None else self.interval)
+        changed = set()
+        for path, mtime in list(self.mtimes.items()):
+            current = self.stat(path)
+            if current != mtime:
+                self.mtimes[path] = current
+                changed.add(path)
+        return changed
+
+    def close(self):
+        pass
+
+class Watcher:
+    def __init__(self, callback, debounce=0.5, interval=2.0, max_delay=5.0):
+        '''
+        Calls callback(key) from the watcher thread once the directory
+        watched under key has changed and been quiet for debounce seconds,
+        or has been changing for max_delay seconds.
+        '''
+        self.callback = callback
+        self.debounce = debounce
+        self.interval = interval
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        self.keys = {}
+        self.paths = {}
+        self.dirty = {}
+        self.pending = []
+        self.thread = None
+        self.backend = None
+
+    def watch(self, key, path):
+        with self.lock:
+            self.keys[key] = path
+            self.paths.setdefault(path, set()).add(key)
+            self.pending.append(('add', path))
+        self.start()
+
+    def start(self):
+        '''
+        Starts the watcher thread if there's anything to watch. A new thread
+        watches every path again, e.g. after stop() on a plugin reload.
+        '''
+        with self.lock:
+            if self.thread is None and self.paths:
+                self.pending = [('add', path) for path in self.paths]
+                self.thread = threading.Thread(target=self.loop, name='SublimeXiki watcher')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def unwatch(self, key):
+        with self.lock:
+            path = self.keys.pop(key, None)
+            keys = self.paths.get(path)
+            if keys is None:
+                return
+
+            keys.discard(key)
+            if not keys:
+                del self.paths[path]
+                self.pending.append(('remove', path))
+
+    def stop(self):
+        with self.lock:
+            self.thread = None
+
+    def create_backend(self):
+        '''
+        Returns inotify on Linux, and a Poller anywhere it can't be loaded.
+        '''
+        if sys.platform.startswith('linux'):
+            try:
+                return Inotify()
+            except Exception:
+                print(traceback.format_exc())
+        return Poller(self.interval)
+
+    def loop(self):
+        try:
+            self.run(self.create_backend())
+        finally:
+            # let start() bring up a new thread if this one died
+            with self.lock:
+                if self.thread is threading.current_thread():
+                    self.thread = None
+
+    def run(self, backend):
+        try:
+            while self.thread is threading.current_thread():
+                with self.lock:
+                    pending, self.pending = self.pending, []
+                for op, path in pending:
+                    if op == 'add':
+                        backend.add(path)
+                    elif path not in self.paths:
+                        backend.remove(path)
+
+                now = time.time()
+                for path in backend.read(self.debounce if self.dirty else 1.0):
+                    first, last = self.dirty.get(path, (now, now))
+                    self.dirty[path] = (first, time.time())
+
+                now = time.time()
+                for path, (first, last) in list(self.dirty.items()):
+                    if now - last >= self.debounce or now - first >= self.max_delay:
+                        del self.dirty[path]
+                        with self.lock:
+                            keys = list(self.paths.get(path, ()))
+                        for key in keys:
+                            try:
+                                self.callback(key)
+                            except Exception:
+                                print(traceback.format_exc())
+        finally:
+            backend.close()
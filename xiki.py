@@ -4,57 +4,230 @@ import sys
 import os
 
 from .lib import util
+from .lib.backend import Backend, BackendError
+from .lib import cache
+from .lib.cache import Cache
+from .lib.reactor import Reactor
+from .lib.scrollback import Scrollback
+from .lib.stream import Terminal
+from .lib.supervisor import Process, Supervisor
+from .lib.timing import span, timings
+from .lib.tree import INDENTATION, TRIM_MARKER, ScanIndex, TreeIndex, more_re
+from .lib.tree import dirname, dispatch, listing_lines, listing_offset, nested_lines, resolve, unslash
+from .lib.watcher import Watcher
 from .edit import Edit
 
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+import bisect
+import codecs
+import concurrent.futures
+import difflib
+import errno
+import itertools
 import json
 import platform
-import queue
 import re
-import shlex
 import subprocess
-import _thread
+import threading
 import time
 import traceback
 
-INDENTATION = '  '
-backspace_re = re.compile('.\b')
+PENDING_LINES = 10000
+# longer rows of command output wrap, instead of being redrawn until they end
+LIVE_WIDTH = 16 * 1024
+LISTING_BATCH = 500
+REGION_CHUNK = 16 * 1024
+COMPLETION_LIMIT = 200
+COMPLETION_WAIT = 0.05
 
 xiki_settings = sublime.load_settings('SublimeXiki.sublime-settings')
 
 class BoundaryError(Exception): pass
 
+# whether XikiTreeIndexer can keep tree_indexes in step with edits (ST4)
+tracks_changes = hasattr(sublime_plugin, 'TextChangeListener')
+
 if not 'already' in globals():
     already = True
     commands = defaultdict(dict)
+    reactor = Reactor()
+    supervisor = Supervisor()
+    spills = defaultdict(list)
+    menus = defaultdict(dict)
+    menu_ids = itertools.count()
+    # held while a worker publishes its xiki process, so cancel_menu() can't miss it
+    menus_lock = threading.Lock()
+    workers = ThreadPoolExecutor(max_workers=4)
+    # scandir calls for recursive expansion, kept apart so walks queued on workers can't starve them
+    scanners = ThreadPoolExecutor(max_workers=8)
+    menu_cache = Cache(name='menus')
+    listing_cache = Cache(size=16, name='listings')
+    backend = None
+    backend_lock = threading.Lock()
+    watched = {}
+    tree_indexes = {}
+    completion_cache = Cache(size=64, name='completions')
+    completion_builds = {}
+    completion_lock = threading.Lock()
+    watcher = Watcher(lambda name: directory_changed(name))
+
+def apply_timing_settings():
+    timings.enabled = bool(xiki_settings.get('performance_stats'))
+    slow = xiki_settings.get('slow_operation_ms')
+    timings.slow = slow / 1000.0 if slow else None
+
+def plugin_loaded():
+    apply_timing_settings()
+    xiki_settings.clear_on_change('SublimeXiki timing')
+    xiki_settings.add_on_change('SublimeXiki timing', apply_timing_settings)
+    util.environment.ttl = xiki_settings.get('environment_ttl')
+    util.environment.refresh()
+    supervisor.grace = xiki_settings.get('kill_timeout', 2.0)
+    # pick up commands, output and watches still running from before a reload
+    supervisor.start()
+    reactor.start()
+    watcher.start()
+
+def plugin_unloaded():
+    global backend
+    reactor.stop()
+    supervisor.stop()
+    watcher.stop()
+    with backend_lock:
+        if backend:
+            backend.close()
+            # the global survives the reload, and get_backend() would hand it out again
+            backend = None
+
+def scrollback_for(tag, overhead):
+    words = tag.split(None, 1)
+    name = os.path.basename(words[0]) if words else ''
+    limits = (xiki_settings.get('scrollback_commands') or {}).get(name) or {}
+    return Scrollback(
+        max_lines=limits.get('lines', xiki_settings.get('scrollback_lines', 0)),
+        max_chars=limits.get('chars', xiki_settings.get('scrollback_chars', 0)),
+        spill=limits.get('spill', xiki_settings.get('scrollback_spill', False)),
+        overhead=overhead,
+    )
 
-def spawn(view, indent, cmd, sel):
-    local_commands = commands[view.id()]
-    q = queue.Queue()
-    def fold(region):
-        regions = view.get_regions(region)
-        for region in regions:
-            lines = view.split_by_newlines(region)
-            if len(lines) > 24:
-
-                lines = lines[1:-24]
-                try:
-                    area = lines.pop()
-                except IndexError:
-                    return
-
-                for sub in lines:
-                    area = area.cover(sub)
-
-                view.unfold(area)
-                view.fold(area)
+def limits_for(tag):
+    words = tag.split(None, 1)
+    name = os.path.basename(words[0]) if words else ''
+    limits = (xiki_settings.get('command_limits') or {}).get(name) or {}
+    memory = limits.get('memory', xiki_settings.get('command_memory_limit'))
+    return {
+        'cpu': limits.get('cpu', xiki_settings.get('command_cpu_limit')),
+        'memory': memory * 2**20 if memory else None,
+        'wall': limits.get('time', xiki_settings.get('command_time_limit')),
+    }
+
+class Output:
+    '''
+    Streams batches of lines pushed from background threads into the view,
+    below the line at sel. The output is tracked with a region called name
+    and merged on the reactor's frame. Below the merged lines is a live tail
+    of rows that can still be redrawn, like a progress bar.
+    '''
+    def __init__(self, view, indent, sel, name, scrollback=None, fold=True):
+        self.view = view
+        self.indent = indent + INDENTATION
+        self.name = name
+        self.scrollback = scrollback
+        self.folding = fold
+        self.cancelled = False
+
+        # batches of lines, appended by background threads
+        self.q = deque()
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.resumes = []
+        # rows to show below the queued lines, None if unchanged
+        self.live = None
+        # rows of the live tail currently in the view
+        self.rows = []
 
-    def merge(region):
-        if q.empty(): return
-        regions = view.get_regions(region)
+        line = view.full_line(sel.b)
+        spread = sublime.Region(line.a, line.b)
+        view.add_regions(name, [spread], 'keyword', '', sublime.DRAW_OUTLINED)
+
+    def push(self, lines, pause=None, resume=None, live=None):
+        '''
+        Queues lines for the view. If merge() is falling behind, calls pause()
+        and returns True, then calls resume() once it has caught up. If live
+        isn't None, it replaces the live tail once the lines are merged.
+        '''
+        with self.lock:
+            if self.cancelled:
+                return False
+            if lines:
+                self.q.append(lines)
+            if live is not None:
+                self.live = live
+            self.pending += len(lines)
+            full = pause is not None and self.pending > PENDING_LINES
+            if full:
+                pause()
+                self.resumes.append(resume)
+
+        reactor.schedule(self.flush)
+        return full
+
+    def flush(self):
+        sublime.set_timeout(self.merge, 0)
+
+    def take(self):
+        '''
+        Returns everything queued. Backpressure keeps that to about
+        PENDING_LINES, and the scrollback trims what is inserted.
+        '''
+        with self.lock:
+            lines = list(itertools.chain.from_iterable(self.q))
+            self.q.clear()
+            self.pending = 0
+            resumes, self.resumes = self.resumes, []
+
+        for resume in resumes:
+            resume()
+        return lines
+
+    def fold(self):
+        view = self.view
+        regions = view.get_regions(self.name)
+        if not regions:
+            return
+
+        region = regions[0]
+        first, _ = view.rowcol(region.a)
+        last, _ = view.rowcol(region.end() - 1)
+        # keep the command line, trim marker and the last 24 lines visible
+        first += 2 if self.scrollback and self.scrollback.trimmed else 1
+        last -= 24
+        if last < first:
+            return
+
+        area = sublime.Region(view.text_point(first, 0), view.line(view.text_point(last, 0)).b)
+        view.unfold(area)
+        view.fold(area)
+
+    def merge(self):
+        view = self.view
+        scrollback = self.scrollback
+        regions = view.get_regions(self.name)
         if not regions: return
 
+        lines = self.take()
+        with self.lock:
+            # the live rows come after everything still queued
+            live = None
+            if not self.q:
+                live, self.live = self.live, None
+        if not lines and live is None: return
+
+        started = time.perf_counter()
         pos = view.line(regions[0].end() - 1)
+        # row of the first line of the live tail
+        first = view.rowcol(pos.a)[0] - len(self.rows) + 1
 
         restore_sel = []
         for sel in view.sel():
@@ -64,20 +237,34 @@ def spawn(view, indent, cmd, sel):
 
         with Edit(view) as edit:
             try:
-                start = time.time()
-                lines = []
-                while time.time() - start < 0.05 and len(lines) < 200:
-                    try:
-                        lines.append(q.get(False))
-                        q.task_done()
-                    except queue.Empty:
-                        break
-
-                if not lines: return
-                lines = backspace_re.sub('', '\n'.join(lines))
-                insert(view, edit, pos, lines, indent + INDENTATION)
-
-                fold(region)
+                chars = 0
+                was_trimmed = scrollback and scrollback.trimmed
+                if scrollback:
+                    chars, lines = scrollback.extend(lines)
+
+                # the live tail becomes the new lines followed by the new live
+                # rows, or just the new lines until the queue drains
+                rows = lines + live if live else lines
+                self.redraw(edit, first, self.rows, rows, pos.b)
+                self.rows = live or []
+
+                if scrollback and scrollback.trimmed:
+                    # oldest output starts below the command line and trim marker
+                    start = view.full_line(regions[0].a).b
+                    if was_trimmed:
+                        start = view.full_line(start).b
+                    else:
+                        if scrollback.path:
+                            spills[view.id()].append(scrollback.path)
+                            marker = TRIM_MARKER + scrollback.path
+                        else:
+                            marker = 'earlier output trimmed'
+                        marker = self.indent + '- ' + marker + '\n'
+                        edit.insert(start, marker)
+                        start += len(marker)
+
+                    if chars:
+                        edit.erase(sublime.Region(start, start + chars))
             except:
                 print(traceback.format_exc())
             finally:
@@ -87,68 +274,481 @@ def spawn(view, indent, cmd, sel):
 
                 edit.callback(restore_selections)
 
-    def poll(p, region, fd):
-        line = True
-        while p.poll() is None or line:
-            line = fd.readline()
-            if isinstance(line, bytes):
-                line = line.decode('utf8')
-
-            if line:
-                q.put(line.rstrip('\r\n'))
-
-        # if the process wasn't terminated
-        out = fd.read()
-        if isinstance(out, bytes):
-            out = out.decode('utf8')
-
-        if out:
-            q.put(out.rstrip('\r\n'))
-            merge(region)
-
-    def out(p, region):
-        last = 0
-        while p.poll() is None:
-            since = time.time() - last
-            if since > 0.05 or since > 0.01 and q.qsize() < 10:
-                last = time.time()
-                merge(region)
-            else:
-                time.sleep(max(0.1 - since, 0.1))
-
-        if p.returncode not in (-9, -15):
-            del local_commands[region]
-            while not q.empty():
-                merge(region)
-                time.sleep(0.05)
+        if self.folding:
+            self.fold()
+        timings.record('merge', time.perf_counter() - started, view.id())
+        if self.q or self.live is not None:
+            reactor.schedule(self.flush)
+
+    def redraw(self, edit, first, old, new, end):
+        '''
+        Turns the rows old, shown from row first to point end, into new.
+        Rows that didn't change aren't touched, and a row that only grew
+        gets just the new text, so a long line isn't inserted over and over.
+        '''
+        view = self.view
+        indent = self.indent
+        common = min(len(old), len(new))
+        if len(new) > common:
+            edit.insert_lines(end, new[common:], indent)
+        elif len(old) > common:
+            start = view.line(view.text_point(first + common - 1, 0)).b
+            edit.erase(sublime.Region(start, end))
+
+        # bottom-up, so each edit leaves the rows above it in place
+        for i in reversed(range(common)):
+            if old[i] != new[i]:
+                line = view.line(view.text_point(first + i, 0))
+                if new[i].startswith(old[i]):
+                    edit.insert(line.b, new[i][len(old[i]):])
+                else:
+                    edit.replace(sublime.Region(line.a + len(indent), line.b), new[i])
+
+    def finish(self, merge=True):
+        '''
+        Called on the UI thread once the producer is done.
+        '''
+        if merge and not self.cancelled:
+            while (self.q or self.live is not None) and self.view.get_regions(self.name):
+                self.merge()
+
+        # after the last merge, which can still spill trimmed lines
+        if self.scrollback:
+            self.scrollback.close()
+
+        self.view.erase_regions(self.name)
+
+    def terminate(self):
+        '''
+        Drops queued and later output, and resumes a paused producer so it
+        can run to EOF.
+        '''
+        with self.lock:
+            self.cancelled = True
+            self.q.clear()
+            self.live = None
+            self.pending = 0
+            resumes, self.resumes = self.resumes, []
+
+        for resume in resumes:
+            resume()
+
+def spawn(view, indent, cmd, sel, tag, cwd=None, pty=False):
+    local_commands = commands[view.id()]
+    # stdout and stderr draw on one screen, as they would in a terminal
+    terminal = Terminal(width=LIVE_WIDTH)
+
+    def reader(fd):
+        decoder = codecs.getincrementaldecoder('utf8')(errors='replace')
+        def read(data):
+            lines = terminal.feed(decoder.decode(data, final=not data))
+            if not data:
+                streams.remove(fd)
+                if not streams:
+                    lines += terminal.close()
+                    output.push(lines, live=[])
+                    reactor.schedule(finish)
+                    return
 
-        view.erase_regions(region)
+            # stop reading until merge() catches up
+            output.push(lines, lambda: reactor.pause(fd), lambda: reactor.resume(fd), terminal.screen())
 
-    p = util.popen(cmd, use_pty=False)
-    if isinstance(p, subprocess.Popen):
-        region = 'xiki sub %i' % p.pid
-        line = view.full_line(sel.b)
-        spread = sublime.Region(line.a, line.b)
-        local_commands[region] = p
-        view.add_regions(region, [spread], 'keyword', '', sublime.DRAW_OUTLINED)
+        return read
 
-        if p.pty:
-            _thread.start_new_thread(poll, (p, region, p.stdout))
+    def finish():
+        if p.poll() is None:
+            # output is closed but the process hasn't exited yet
+            reactor.schedule(finish)
+        else:
+            sublime.set_timeout(done, 0)
+
+    def done():
+        local_commands.pop(output.name, None)
+        if p.reason:
+            output.push(['killed: ' + p.reason])
+        # output of a command stopped by collapsing its node is thrown away
+        output.finish(merge=p.stopping is None or p.reason is not None)
+
+    with span('spawn', view.id()):
+        p = supervisor.launch(util.popen, cmd, tag, use_pty=pty, cwd=cwd, **limits_for(tag))
+    if isinstance(p, Process):
+        name = 'xiki sub %i' % p.pid
+        scrollback = scrollback_for(tag, len(indent + INDENTATION) + 1)
+        output = Output(view, indent, sel, name, scrollback)
+        local_commands[name] = (p, output)
+
+        pipes = p.popen
+        if pipes.pty:
+            streams = [pipes.stdout.fileno()]
         else:
-            _thread.start_new_thread(poll, (p, region, p.stderr))
-            _thread.start_new_thread(poll, (p, region, p.stdout))
-        _thread.start_new_thread(out, (p, region))
+            streams = [pipes.stderr.fileno(), pipes.stdout.fileno()]
+
+        for fd in list(streams):
+            reactor.add_reader(fd, reader(fd))
     else:
         with Edit(view) as edit:
             insert(view, edit, sel, 'Error: ' + (p or ''), indent + INDENTATION)
 
+def expand_directory(view, indent, sign, tag, sel, target):
+    vid = view.id()
+    end = view.line(sel.b).b
+    with Edit(view) as edit:
+        if sign == '+':
+            replace_line(view, edit, end, indent + '- ' + tag)
+        edit.insert(end, '\n' + indent + INDENTATION)
+
+    name = 'xiki dir %i' % next(menu_ids)
+    output = Output(view, indent, sel, name, fold=False)
+    menus[vid][name] = output
+
+    def run():
+        event = threading.Event()
+        lines = directory_lines(target)
+        for i in range(0, len(lines), LISTING_BATCH):
+            if output.cancelled:
+                return
+
+            if output.push(lines[i:i + LISTING_BATCH], event.clear, event.set):
+                event.wait()
+
+        sublime.set_timeout(done, 0)
+
+    def done():
+        if menus[vid].pop(name, None) is not None:
+            regions = view.get_regions(name)
+            if regions and xiki_settings.get('watch_directories'):
+                watch_directory(view, view.line(regions[0].a), indent, target)
+            output.finish()
+
+    workers.submit(run)
+
+def expand_recursive(view, sel, depth, budget):
+    '''
+    Replaces the listing below the directory node at sel with its subtree,
+    depth levels deep, in a single edit once the whole walk is done.
+    Returns False if the node isn't a directory.
+    '''
+    row, _ = view.rowcol(sel.b)
+    indent, _, path, tag, tree = find_tree(view, row)
+    if not path:
+        return False
+
+    d, f = os.path.split(os.path.join(path, tree))
+    target = os.path.join(d, unslash(f))
+    if not os.path.isdir(target):
+        return False
+
+    # find_tree() reports the sign of a path node as /
+    sign = tree_index(view).parse(row)[1]
+    stop_subtree(view, sel.b, indent)
+    if get_line(view, row + 1).startswith(indent + INDENTATION):
+        with Edit(view) as edit:
+            cleanup(view, edit, view.line(sel.b).b, indent + INDENTATION)
+
+    vid = view.id()
+    name = add_placeholder(view, indent, sel)
+    ignore = xiki_settings.get('expand_ignore') or ()
+    page_size = xiki_settings.get('directory_page_size', 1000)
+
+    def run():
+        if not name in menus[vid]:
+            return
+
+        with span('walk_dir', vid):
+            listings = util.walk_dir(target, depth, budget, ignore, scanners.map)
+
+        if target in listings:
+            output = '\n'.join(nested_lines(target, listings, page_size, INDENTATION))
+        else:
+            # couldn't be listed, show why
+            output = '\n'.join(directory_lines(target, cached=False))
+        sublime.set_timeout(lambda: patch_placeholder(view, name, indent, sign, tag, output), 0)
+
+    workers.submit(run)
+    return True
+
+def watch_directory(view, line, indent, target):
+    name = 'xiki watch %i' % next(menu_ids)
+    view.add_regions(name, [line], '', '', sublime.HIDDEN)
+    watched[name] = (view, indent, target)
+    watcher.debounce = xiki_settings.get('watch_debounce', 0.5)
+    watcher.interval = xiki_settings.get('watch_poll_interval', 2.0)
+    watcher.watch(name, target)
+
+def unwatch_directory(view, name):
+    watcher.unwatch(name)
+    watched.pop(name, None)
+    view.erase_regions(name)
+
+def directory_changed(name):
+    # called from the watcher thread
+    try:
+        view, indent, target = watched[name]
+    except KeyError:
+        return
+
+    try:
+        listing = directory_listing(target, cached=False)
+    except OSError as err:
+        listing = err
+    sublime.set_timeout(lambda: refresh_directory(view, name, indent, listing), 0)
+
+def entry_key(line):
+    if line.startswith(('+ ', '- ')):
+        return line[2:]
+    return line
+
+def refresh_directory(view, name, indent, listing):
+    '''
+    Applies the difference between the listing shown below a watched
+    directory node and its new listing, (dirs, files) or the OSError from
+    listing it, leaving expanded children alone.
+    '''
+    regions = view.get_regions(name)
+    if not regions or not name in watched:
+        unwatch_directory(view, name)
+        return
+
+    child = indent + INDENTATION
+    last_row, _ = view.rowcol(view.size())
+    row, _ = view.rowcol(regions[0].a)
+
+    # rows of the direct children, plus the row where the listing ends;
+    # lines indented deeper belong to the child above them, so deleting a
+    # child takes its expanded subtree along
+    rows = []
+    keys = []
+    blank = None
+    row += 1
+    while row <= last_row:
+        line = get_line(view, row)
+        if line.startswith(child) and len(line) > len(child):
+            if not line[len(child)].isspace():
+                rows.append(row)
+                keys.append(entry_key(line[len(child):]))
+            blank = None
+        elif not line.strip():
+            # part of the listing only if more of it follows
+            if blank is None:
+                blank = row
+        else:
+            break
+        row += 1
+
+    if not rows:
+        # the node was collapsed
+        unwatch_directory(view, name)
+        return
+
+    if blank is not None:
+        row = blank
+    if isinstance(listing, OSError):
+        lines = ['- ' + listing.strerror]
+    else:
+        # as many entries as are shown, which is more than a page once
+        # the user has opened "more..."
+        shown = sum(1 for key in keys if not more_re.match(key))
+        page_size = max(xiki_settings.get('directory_page_size', 1000), shown)
+        lines = listing_lines(listing[0], listing[1], 0, page_size)
+
+    rows.append(row)
+    points = [view.text_point(r, 0) for r in rows]
+    if row > last_row:
+        points[-1] = view.size()
+
+    matcher = difflib.SequenceMatcher(None, keys, [entry_key(line) for line in lines], False)
+    with Edit(view) as edit:
+        for op, i1, i2, j1, j2 in reversed(matcher.get_opcodes()):
+            if op in ('delete', 'replace'):
+                edit.erase(sublime.Region(points[i1], points[i2]))
+            if op in ('insert', 'replace'):
+                text = ''.join(child + line + '\n' for line in lines[j1:j2])
+                if points[i1] == view.size() and view.substr(points[i1] - 1) != '\n':
+                    text = '\n' + text.rstrip('\n')
+                edit.insert(points[i1], text)
+
+def get_backend():
+    global backend
+    cmd = xiki_settings.get('xiki_backend')
+    size = xiki_settings.get('xiki_backend_workers', 1)
+    with backend_lock:
+        if backend and (backend.closed or backend.cmd != cmd or backend.size != size):
+            backend.close()
+            backend = None
+
+        if cmd and not backend:
+            backend = Backend(cmd, size)
+
+        return backend
+
+def menu_cache_key(tree):
+    env = util.create_environment()
+    try:
+        cwd = os.getcwd()
+    except FileNotFoundError:
+        cwd = None
+
+    backend = xiki_settings.get('xiki_backend')
+    fingerprint = hash((cwd, tuple(backend or ()), frozenset(env.items())))
+    return tree, fingerprint
+
+def menu_name(tree):
+    return tree.split(os.sep, 1)[0].split(' ', 1)[0]
+
+def menu_cache_ttl(tree):
+    ttls = xiki_settings.get('menu_cache_ttls') or {}
+    return ttls.get(menu_name(tree), xiki_settings.get('menu_cache_ttl', 0))
+
+def add_placeholder(view, indent, sel):
+    '''
+    Inserts a "..." line below the node at sel to be replaced by
+    patch_placeholder(), and returns its name in menus.
+    '''
+    name = 'xiki menu %i' % next(menu_ids)
+    line = view.line(sel.b)
+    placeholder = '\n' + indent + INDENTATION + '...'
+    with Edit(view) as edit:
+        edit.insert(line.b, placeholder)
+
+    spread = sublime.Region(line.a, line.b + len(placeholder))
+    view.add_regions(name, [spread], 'comment', '', sublime.HIDDEN)
+    menus[view.id()][name] = None
+    return name
+
+def patch_placeholder(view, name, indent, sign, tag, output):
+    if not name in menus[view.id()]:
+        return
+
+    del menus[view.id()][name]
+    regions = view.get_regions(name)
+    view.erase_regions(name)
+    if not regions:
+        return
+
+    region = regions[0]
+    with Edit(view) as edit:
+        if output:
+            lines = output.split('\n')
+            text = '\n'.join(indent + INDENTATION + line for line in lines)
+            edit.replace(view.line(region.b), text)
+            if sign == '+':
+                replace_line(view, edit, region.a, indent + '- ' + tag)
+        else:
+            edit.erase(sublime.Region(view.line(region.a).b, region.b))
+
+def expand_menu(view, indent, sign, tag, sel, cmd, tree):
+    vid = view.id()
+    key = menu_cache_key(tree)
+    ttl = menu_cache_ttl(tree)
+    menu_cache.size = xiki_settings.get('menu_cache_size', 256)
+    name = add_placeholder(view, indent, sel)
+
+    def run():
+        if not name in menus[vid]:
+            return
+
+        try:
+            output = fetch()
+        except Exception as err:
+            # the placeholder is patched either way, or it would stay forever
+            print(traceback.format_exc())
+            output = 'Error: %s' % err
+
+        if output is not None:
+            sublime.set_timeout(lambda: patch(output), 0)
+
+    def fetch():
+        '''
+        Returns the menu's output, or None if it was cancelled.
+        '''
+        ok = False
+        backend = get_backend()
+        with span('menu', vid):
+            if backend:
+                try:
+                    output = backend.request(tree, 3)
+                    ok = not output.startswith('Error: ')
+                except BackendError as err:
+                    output = 'Error: %s' % err
+            else:
+                p = util.popen(cmd)
+                if isinstance(p, subprocess.Popen):
+                    with menus_lock:
+                        cancelled = not name in menus.get(vid, ())
+                        if not cancelled:
+                            menus[vid][name] = p
+                    if cancelled:
+                        try:
+                            p.terminate()
+                        except OSError:
+                            pass
+                        return None
+
+                    output = util.wait(p, None, 3)
+                    ok = p.returncode == 0
+                else:
+                    output = 'Error: ' + (p or '')
+
+        if ok and ttl:
+            menu_cache.set(key, output, ttl)
+        return output
+
+    def patch(output):
+        patch_placeholder(view, name, indent, sign, tag, output)
+
+    output = menu_cache.get(key) if ttl else None
+    if output is not None:
+        patch(output)
+    else:
+        workers.submit(run)
+
+def cancel_menu(view, name):
+    with menus_lock:
+        p = menus[view.id()].pop(name, None)
+    view.erase_regions(name)
+    if p is not None:
+        try:
+            p.terminate()
+        except OSError:
+            pass
+
+def directory_listing(target, cached=True):
+    '''
+    Returns the sorted (dirs, files) in target. Raises OSError.
+    '''
+    if platform.system() == 'Windows' and target == '/':
+        return [drive + ':' for drive in util.get_windows_drives()], []
+
+    key = (target, os.stat(target).st_mtime)
+    listing = listing_cache.get(key) if cached else None
+    if listing is None:
+        with span('list_dir'):
+            listing = util.list_dir(target)
+        listing_cache.set(key, listing)
+    return listing
+
+def directory_lines(target, offset=0, cached=True, after=None):
+    '''
+    Returns the lines of a page of target's listing, starting at offset, or
+    after the entry on the line after if given.
+    '''
+    try:
+        dirs, files = directory_listing(target, cached)
+    except OSError as err:
+        return ['- ' + err.strerror]
+
+    if after is not None:
+        offset = listing_offset(dirs, files, after)
+    return listing_lines(dirs, files, offset, xiki_settings.get('directory_page_size', 1000))
+
 def xiki(view, cont=False):
     if is_xiki_buffer(view):
-        for sel in view.sel():
+        # bottom-up, so edits for one cursor don't move the ones still to come
+        for sel in reversed(list(view.sel())):
             output = None
             cmd = None
             persist = False
-            oldcwd = None
+            cwd = None
             op = None
             scroll = False
             windows = platform.system() == 'Windows'
@@ -160,7 +760,8 @@ def xiki(view, cont=False):
                     edit.insert(view.size(), '\n')
 
             row, _ = view.rowcol(sel.b)
-            indent, sign, path, tag, tree = find_tree(view, row)
+            with span('find_tree', view.id()):
+                indent, sign, path, tag, tree = find_tree(view, row)
 
             pos = view.line(sel.b).b
             if get_line(view, row+1).startswith(indent + INDENTATION):
@@ -168,102 +769,54 @@ def xiki(view, cont=False):
                     with Edit(view) as edit:
                         replace_line(view, edit, pos, indent + '+ ' + tag)
 
-                do_clean = True
-                check = sublime.Region(sel.b, sel.b)
-                for name, process in list(commands[view.id()].items()):
-                    regions = view.get_regions(name)
-                    for region in regions:
-                        if region.contains(check):
-                            try:
-                                process.terminate()
-                            except OSError:
-                                pass
-
-                            do_clean = False
-
+                # a running command is stopped, and its output left in place
+                do_clean = not stop_subtree(view, sel.b, indent)
                 if do_clean and not cont:
                     op = 'cleanup'
                     with Edit(view) as edit:
                         cleanup(view, edit, pos, indent + INDENTATION)
                 # select(view, pos)
-            elif sign == '$' or sign == '$$':
-                op = 'command'
+            else:
+                op, target = dispatch(sign, path, tag, tree)
+
+            if op == 'trimmed':
+                # open output trimmed from a command's scrollback
+                op = 'file'
+                if os.path.isfile(target) and not cont:
+                    sublime.active_window().open_file(target)
+            elif op == 'more':
+                # next page of a long directory listing
+                op = 'dir'
+                shown = int(more_re.match(tag).group(1))
+                lines = directory_lines(target, shown, after=last_entry(view, row, indent))
+                with Edit(view) as edit:
+                    edit.replace(view.line(pos), '\n'.join(indent + line for line in lines))
+            elif op == 'command':
                 error = None
 
-                p = os.path.expanduser('~')
-                if path:
-                    p = dirname(path, tree, tag)
-                    if windows:
-                        p = p.lstrip('/')
-                try:
-                    oldcwd = os.getcwd()
-                except FileNotFoundError:
-                    pass
+                cwd = target
+                if not os.path.isdir(cwd):
+                    error = FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), cwd)
+
                 try:
-                    os.chdir(p)
-                except Exception as err:
+                    cmd = util.shell_command(tag)
+                except ValueError as err:
                     error = err
 
-                env = util.create_environment()
-                shell = env.get('SHELL')
-                if shell and util.which(shell):
-                    cmd = [shell, '-c', tag]
-                elif windows:
-                    cmd = ['cmd', '/c', tag]
-                if not cmd:
-                    try:
-                        cmd = shlex.split(tag, True)
-                    except ValueError as err:
-                        error = err
-
                 if error:
                     cmd = None
                     output = str(error) + '\n'
 
                 persist = True
-            elif path:
-                # directory listing or file open
-                target = os.path.join(path, tree)
-                d, f = os.path.split(target)
-                f = unslash(f)
-                target = os.path.join(d, f)
-
-                if os.path.isfile(target):
-                    op = 'file'
-                    if windows:
-                        target = os.path.abspath(target)
-
-                    if not cont:
-                        sublime.active_window().open_file(target)
-                elif os.path.isdir(target):
-                    op = 'dir'
-                    dirs = ''
-                    files = ''
-                    listing = []
-                    try:
-                        if windows and target == '/':
-                            listing = [drive + ':' for drive in util.get_windows_drives()]
-                        else:
-                            listing = os.listdir(target)
-                    except OSError as err:
-                        dirs = '- ' + err.strerror + '\n'
-
-                    if windows and target.startswith('/'):
-                        target = target.lstrip('/')
-
-                    for entry in listing:
-                        absolute = os.path.join(target, entry)
-                        if os.path.isdir(absolute):
-                            dirs += '+ %s%s\n' % (entry, os.sep)
-                        else:
-                            entry = slash(entry, '\\+$-')
-                            files += '%s\n' % entry
-
-                    output = (dirs + files) or ' '
-            elif sign == '-':
-                # dunno here
-                pass
-            elif tree:
+            elif op == 'file':
+                if windows:
+                    target = os.path.abspath(target)
+
+                if not cont:
+                    sublime.active_window().open_file(target)
+            elif op == 'dir':
+                expand_directory(view, indent, sign, tag, sel, target)
+            elif op == 'menu':
                 op = 'xiki'
                 cmd = ['xiki']
                 cmd += tree.split(' ')
@@ -273,12 +826,10 @@ def xiki(view, cont=False):
                     end = view.line(sel.b).b
                     with Edit(view) as edit:
                         edit.insert(end, '\n' + indent + INDENTATION)
-                    spawn(view, indent, cmd, sel)
+                    pty = sign == '$$' and xiki_settings.get('pty_commands', False)
+                    spawn(view, indent, cmd, sel, tag, cwd, pty)
                 else:
-                    output = util.communicate(cmd, None, 3)
-
-                if oldcwd:
-                    os.chdir(oldcwd)
+                    expand_menu(view, indent, sign, tag, sel, cmd, tree)
 
             if output:
                 with Edit(view) as edit:
@@ -314,78 +865,25 @@ def xiki(view, cont=False):
             if scroll:
                 view.show_at_center(sel)
 
-def find_tree(view, row):
-    regex = re.compile(r'^(\s*)(\$\$|[-+$]\s*)?(.*)$')
-
-    line = get_line(view, row)
-    match = regex.match(line)
+def tree_index(view):
+    buffer_id = view.buffer_id()
+    count = view.change_count()
+    index = tree_indexes.get(buffer_id)
+    if index is None or index.change_count != count:
+        if not tracks_changes:
+            # rebuilding would copy the whole buffer after every keystroke
+            return ScanIndex(lambda row: get_line(view, row))
 
-    line_indent = last_indent = match.group(1)
-    sign = (match.group(2) or '').strip()
-    tag = match.group(3)
-    tree = [tag]
-    if tag.startswith('/'):
-        sign = '/'
+        index = TreeIndex(view.substr(sublime.Region(0, view.size())), count)
+        tree_indexes[buffer_id] = index
 
-    offset = -1
-    while last_indent != '':
-        try:
-            line = get_line(view, row+offset)
-        except BoundaryError:
-            break
-
-        offset -= 1
-
-        match = regex.match(line)
-        if match:
-            indent = match.group(1)
-            part = match.group(3)
-
-            if len(indent) < len(last_indent) and part:
-                last_indent = indent
-                tree.insert(0, part)
-
-    new_tree = []
-    path = None
-    for part in reversed(tree):
-        if part.startswith('@'):
-            new_tree.insert(0, part.strip('@'))
-        elif part.startswith(('/', os.sep)):
-            path = part
-        elif re.match(r'^[A-Z]:\\', part):
-            path = part
-        elif part.startswith('~'):
-            path = os.path.expanduser(part)
-        else:
-            new_tree.insert(0, part)
-            continue
-
-        break
+    return index
 
-    return line_indent, sign, path, tag, os.sep.join(new_tree).replace(os.sep * 2, os.sep)
+def find_tree(view, row):
+    return resolve(tree_index(view), row)
 
 # helpers
 
-def slash(s, chars):
-    if re.match(r'^[%s]' % re.escape(chars), s):
-        s = '\\' + s
-
-    return s
-
-def unslash(s):
-    out = ''
-    escaped = False
-    for c in s:
-        if escaped:
-            escaped = False
-            out += c
-        elif c == '\\':
-            escaped = True
-        else:
-            out += c
-
-    return out
-
 def replace_line(view, edit, point, text):
     text = text.rstrip()
     line = view.full_line(point)
@@ -393,13 +891,37 @@ def replace_line(view, edit, point, text):
     edit.insert(line.b, text + '\n')
     edit.erase(line)
 
+def iter_lines(view, row):
+    '''
+    Yields the lines of the buffer from row onwards, like
+    view.substr(...).split('\\n') would, without copying the whole tail.
+    '''
+    index = tree_indexes.get(view.buffer_id())
+    if index is not None and index.change_count == view.change_count():
+        lines = index.lines
+        if row >= len(lines):
+            yield ''
+        for i in range(row, len(lines)):
+            yield lines[i]
+        return
+
+    point = view.text_point(row, 0)
+    size = view.size()
+    partial = ''
+    while point < size:
+        end = min(point + REGION_CHUNK, size)
+        lines = (partial + view.substr(sublime.Region(point, end))).split('\n')
+        partial = lines.pop()
+        yield from lines
+        point = end
+
+    yield partial
+
 def find_region(view, pos, indent):
     line, _ = view.rowcol(pos)
 
-    point = view.text_point(line + 1, 0)
-    text = view.substr(sublime.Region(point, view.size()))
     count = 0
-    for l in text.split('\n'):
+    for l in iter_lines(view, line + 1):
         if not l.startswith(indent) and l.strip():
             break
         else:
@@ -413,17 +935,60 @@ def find_region(view, pos, indent):
     )
     return region
 
+def stop_subtree(view, pos, indent):
+    '''
+    Stops the commands, pending menus and directory watches of the node at
+    pos and everything indented under it, before the node is collapsed or
+    its children are replaced. Returns True if the node itself was a
+    running command.
+    '''
+    vid = view.id()
+    node = view.full_line(pos)
+    end = max(node.b, find_region(view, pos, indent + INDENTATION).b)
+
+    def starts(name):
+        return [region.a for region in view.get_regions(name) if node.a <= region.a < end]
+
+    running = False
+    for name, (process, stream) in list(commands[vid].items()):
+        points = starts(name)
+        if points:
+            supervisor.terminate(process)
+            stream.terminate()
+            running = running or node.a in points
+
+    for name in list(menus[vid]):
+        if starts(name):
+            cancel_menu(view, name)
+
+    for name, (watching, _, _) in list(watched.items()):
+        if watching.id() == vid and starts(name):
+            unwatch_directory(view, name)
+
+    return running
+
+def last_entry(view, row, indent):
+    '''
+    Returns the nearest line above row at exactly indent, without the
+    indent, or None if there's none before the parent.
+    '''
+    for r in range(row - 1, -1, -1):
+        line = get_line(view, r)
+        if not line.strip():
+            continue
+        if not line.startswith(indent):
+            return None
+        if not line[len(indent)].isspace():
+            return line[len(indent):]
+    return None
+
 def cleanup(view, edit, pos, indent):
     region = find_region(view, pos, indent)
     edit.erase(region)
 
 def insert(view, edit, sel, text, indent='', cleanup=True):
     pos = view.line(sel.b).b
-
-    lines = reversed(text.split('\n'))
-    for line in lines:
-        line = '\n' + indent + line
-        edit.insert(pos, line)
+    edit.insert_lines(pos, text.split('\n'), indent)
 
 def get_line(view, row=0):
     point = view.text_point(row, 0)
@@ -433,27 +998,70 @@ def get_line(view, row=0):
     line = view.line(point)
     return view.substr(line).strip('\r\n')
 
-def dirname(path, tree, tag):
-    path_re = r'^(.+)%s%s$' % (re.escape(os.sep), re.escape(tag))
-    match = re.match(path_re, tree)
-    if match:
-        return os.path.join(path, match.group(1))
-    else:
-        return path
+def build_completion_index(base, mtime):
+    try:
+        names = sorted(os.listdir(base), key=str.lower)
+    except OSError:
+        names = []
+
+    index = (mtime, [name.lower() for name in names], names)
+    completion_cache.set(base, index)
+    with completion_lock:
+        completion_builds.pop(base, None)
+    return index
+
+def completion_index(base):
+    '''
+    Returns (mtime, lowercase names, names) for base, sorted by lowercase
+    name. Big directories are indexed on the worker pool; until that's
+    done this returns the previous index for base, or None.
+    '''
+    try:
+        mtime = os.stat(base).st_mtime_ns
+    except OSError:
+        return None
+
+    index = completion_cache.get(base)
+    if index is not None and index[0] == mtime:
+        return index
+
+    with completion_lock:
+        future = completion_builds.get(base)
+        if future is None:
+            future = workers.submit(build_completion_index, base, mtime)
+            completion_builds[base] = future
+
+    try:
+        return future.result(COMPLETION_WAIT)
+    except concurrent.futures.TimeoutError:
+        return index
 
 def completions(base, partial, executable=False):
     if os.path.isdir(base):
-        ret = []
+        index = completion_index(base)
+        if index is None:
+            return []
+
+        _, keys, names = index
         partial = partial.lower()
+        start = bisect.bisect_left(keys, partial)
+        end = bisect.bisect_left(keys, partial + '\U0010ffff', start)
 
-        for name in os.listdir(base):
-            path = os.path.join(base, name)
-            if name.lower().startswith(partial):
-                if not executable or os.access(path, os.X_OK):
-                    ret.append((name, name))
+        ret = []
+        for name in names[start:end]:
+            if not executable or os.access(os.path.join(base, name), os.X_OK):
+                ret.append((name, name))
+                if len(ret) >= COMPLETION_LIMIT:
+                    break
 
         return ret
 
+def show_panel(window, text):
+    panel = window.create_output_panel('xiki')
+    with Edit(panel) as edit:
+        edit.insert(0, text)
+    window.run_command('show_panel', {'panel': 'output.xiki'})
+
 def apply_xiki_settings(view):
     settings = view.settings()
     settings.set('tab_size', 2)
@@ -468,6 +1076,43 @@ def is_xiki_buffer(view):
 
 # sublime event classes
 
+if tracks_changes:
+    class XikiTreeIndexer(sublime_plugin.TextChangeListener):
+        '''
+        Keeps tree_indexes in step with buffer edits so find_tree() never
+        has to re-read the buffer. Without this listener (ST3), find_tree()
+        scans up from the row whenever the view's change count has moved.
+        '''
+        @classmethod
+        def is_applicable(cls, buffer):
+            return True
+
+        def on_text_changed(self, changes):
+            buffer_id = self.buffer.id()
+            index = tree_indexes.get(buffer_id)
+            view = self.buffer.primary_view()
+            if index is None or view is None:
+                return
+
+            count = view.change_count()
+            if index.change_count is None or index.change_count >= count:
+                # already built from the changed buffer
+                return
+
+            try:
+                for change in changes:
+                    index.change(change.a.row, change.a.col, change.b.row, change.b.col, change.str)
+            except IndexError:
+                index = None
+            else:
+                if len(index) != view.rowcol(view.size())[0] + 1:
+                    index = None
+
+            if index is None:
+                del tree_indexes[buffer_id]
+            else:
+                index.change_count = count
+
 class XikiListener(sublime_plugin.EventListener):
     def on_query_completions(self, view, prefix, locations):
         if is_xiki_buffer(view):
@@ -476,9 +1121,11 @@ class XikiListener(sublime_plugin.EventListener):
                 row, _ = view.rowcol(sel[0].b)
                 indent, sign, path, tag, tree = find_tree(view, row)
 
-                if sign == '$':
+                if sign in ('$', '$$'):
                     # command completion
-                    pass
+                    if not ' ' in tag.strip():
+                        names = util.complete_command(tag.strip())[:COMPLETION_LIMIT]
+                        return [(name, name) for name in names], sublime.INHIBIT_WORD_COMPLETIONS
                 elif path:
                     # directory/file completion
                     target, partial = os.path.split(dirname(path, tree, tag))
@@ -502,17 +1149,32 @@ class XikiListener(sublime_plugin.EventListener):
 
     def on_close(self, view):
         vid = view.id()
-        for process in list(commands[vid].values()):
+        for process, output in list(commands[vid].values()):
+            supervisor.terminate(process)
+            output.terminate()
+
+        del commands[vid]
+
+        for name in list(menus[vid]):
+            cancel_menu(view, name)
+        del menus[vid]
+
+        for name, (watching, _, _) in list(watched.items()):
+            if watching.id() == vid:
+                unwatch_directory(view, name)
+
+        tree_indexes.pop(view.buffer_id(), None)
+
+        for path in spills.pop(vid, ()):
             try:
-                process.terminate()
+                os.unlink(path)
             except OSError:
                 pass
 
-        del commands[vid]
-
 class Xiki(sublime_plugin.TextCommand):
     def run(self, edit):
-        xiki(self.view)
+        with span('xiki', self.view.id()), Edit.transaction(self.view, edit):
+            xiki(self.view)
 
     def is_enabled(self):
         if is_xiki_buffer(self.view):
@@ -521,7 +1183,97 @@ class Xiki(sublime_plugin.TextCommand):
 
 class XikiContinue(Xiki):
     def run(self, edit):
-        xiki(self.view, cont=True)
+        with span('xiki', self.view.id()), Edit.transaction(self.view, edit):
+            xiki(self.view, cont=True)
+
+class XikiExpandRecursive(sublime_plugin.TextCommand):
+    def run(self, edit, depth=None, budget=None):
+        if depth is None:
+            depth = xiki_settings.get('expand_depth', 3)
+        if budget is None:
+            budget = xiki_settings.get('expand_budget', 10000)
+
+        view = self.view
+        with Edit.transaction(view, edit):
+            for sel in reversed(list(view.sel())):
+                if not expand_recursive(view, sel, depth, budget or None):
+                    sublime.status_message('Xiki: not a directory')
+
+    def is_enabled(self):
+        return is_xiki_buffer(self.view)
+
+class XikiClearCache(sublime_plugin.WindowCommand):
+    def run(self, menu=None):
+        if menu:
+            count = menu_cache.invalidate(lambda key: menu_name(key[0]) == menu)
+        else:
+            count = menu_cache.invalidate()
+
+        stats = menu_cache.stats()
+        sublime.status_message('Xiki: cleared %i cached menus (%i hits, %i misses, %i evictions)' % (
+            count, stats['hits'], stats['misses'], stats['evictions']))
+
+class XikiRefreshEnvironment(sublime_plugin.WindowCommand):
+    def run(self):
+        util.environment.refresh()
+        util.executables.checked = 0
+
+class XikiCacheStats(sublime_plugin.WindowCommand):
+    def run(self):
+        lines = ['%-30s %8s %10s %10s %10s' % ('cache', 'size', 'hits', 'misses', 'evictions')]
+        for name, c in sorted(cache.registry.items()):
+            stats = c.stats()
+            lines.append('%-30s %8i %10i %10i %10i' % (
+                name, stats['size'], stats['hits'], stats['misses'], stats['evictions']))
+
+        show_panel(self.window, '\n'.join(lines))
+
+class XikiPerformanceStats(sublime_plugin.WindowCommand):
+    def run(self, reset=False):
+        if reset:
+            timings.reset()
+            sublime.status_message('Xiki: performance stats cleared')
+            return
+
+        if not timings.enabled:
+            show_panel(self.window, 'Set "performance_stats": true in the SublimeXiki settings to collect timings.')
+            return
+
+        def ms(seconds):
+            return '%.2f' % (seconds * 1000)
+
+        lines = ['%-12s %-8s %8s %10s %10s %10s %12s' % ('operation', 'view', 'count', 'p50 ms', 'p99 ms', 'max ms', 'total ms')]
+        for name, vid, histogram in timings.stats():
+            lines.append('%-12s %-8s %8i %10s %10s %10s %12s' % (
+                name if vid is None else '', 'all' if vid is None else vid, histogram.count,
+                ms(histogram.percentile(50)), ms(histogram.percentile(99)),
+                ms(histogram.max), ms(histogram.total)))
+
+        show_panel(self.window, '\n'.join(lines))
+
+class XikiRunningCommands(sublime_plugin.WindowCommand):
+    def run(self):
+        running = supervisor.running()
+        if not running:
+            sublime.status_message('SublimeXiki: no commands running')
+            return
+
+        supervisor.sample(running)
+
+        items = []
+        for process in running:
+            usage = 'pid %i, %is' % (process.pid, process.elapsed)
+            if process.cpu is not None:
+                usage += ', cpu %.1fs, %iMB' % (process.cpu, process.rss // 2**20)
+            if process.stopping is not None:
+                usage += ', stopping'
+            items.append([process.name, usage])
+
+        def on_done(i):
+            if i >= 0:
+                supervisor.terminate(running[i])
+
+        self.window.show_quick_panel(items, on_done)
 
 class NewXiki(sublime_plugin.WindowCommand):
     def run(self):
@@ -542,4 +1294,4 @@ class XikiClick(sublime_plugin.WindowCommand):
 
             sel.clear()
             sel.add(sublime.Region(s.b, s.a))
-            xiki(view)
+            view.run_command('xiki')